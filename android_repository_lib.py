@@ -1,11 +1,20 @@
+import cache_lib
 import collections
+import concurrent.futures
 import datetime
 import hashlib
+import http_lib
+import itertools
+import metrics_lib
 import os
+import pickle
+import pipeline_lib
 import pkgbuild_lib
 import re
 import sys
-import urllib, urllib.error, urllib.request
+import threading
+import urllib, urllib.error, urllib.parse
+import verify_lib
 import xml.etree.ElementTree as etree
 import xmltodict
 
@@ -13,20 +22,86 @@ import xmltodict
 def namespace_format(namespace, tag):
     return '{{{namespace}}}{tag}'.format(namespace=namespace, tag=tag)
 
+LATEST_URL_INDEXES_CACHE_NAME = 'android-latest-url-indexes.json'
+ANDROID_CATALOG_SNAPSHOT_NAME = 'android-catalog.pickle'
+# Bump when the records or the catalog change, to ignore older snapshots
+ANDROID_CATALOG_SNAPSHOT_VERSION = 2
+_latest_url_indexes_lock = threading.Lock()
+
+def url_exists(url):
+    """Return whether `url` is found. Only the headers are requested, or the
+    body is left unread when the server does not allow HEAD requests, so
+    that probing an url does not download it."""
+    try:
+        try:
+            response = http_lib.open_url(url, method='HEAD')
+        except urllib.error.HTTPError as e:
+            if e.code not in (405, 501):
+                raise
+            e.close()
+            response = http_lib.open_url(url)
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise e
+        # Let the connection be reused by the next probe
+        e.close()
+        return False
+    response.close()
+    return True
+
+def find_latest_index(url_pattern, indexes, delim='-'):
+    """Probe concurrently the urls constructed from `url_pattern` and each
+    of the `indexes`. Return the highest index whose url is found or None if
+    no url is found."""
+    indexes = sorted(indexes, reverse=True)
+    with concurrent.futures.ThreadPoolExecutor(len(indexes)) as executor:
+        exist = executor.map(url_exists, [url_pattern.format(delim=delim,
+            num=i) for i in indexes])
+        for i, exists in zip(indexes, exist):
+            if exists:
+                return i
+    return None
+
 def get_latest_url(url_pattern, num_max=None, delim='-'):
     """Return a request object for the latest url available for consumption.
     The url is constructed by formatting `url_pattern` with `delim` and an
     index ranging from 1 to `num_max`, inclusive. The latest url is obtained by
-    finding the highest index in which the constructed url successfully return."""
+    finding the highest index in which the constructed url successfully return.
+    The indexes are only probed, and the latest url alone is downloaded
+    through the http cache.
+
+    The latest index is remembered between runs: the next call first probes
+    only that index and the one above it, and probes every index
+    concurrently only when both are not found."""
     if num_max is not None:
-        for i in range(num_max, 0, -1):
-            url_to_be_open = url_pattern.format(delim=delim, num=i)
-            try:
-                return urllib.request.urlopen(url_to_be_open)
-            except urllib.error.HTTPError as e:
-                if e.code != 404:
-                    raise e
-    return urllib.request.urlopen(url_pattern.format(delim='', num=''))
+        with _latest_url_indexes_lock:
+            latest_indexes = cache_lib.load_json(
+                    LATEST_URL_INDEXES_CACHE_NAME, {})
+        cached_index = latest_indexes.get(url_pattern)
+
+        latest_index = None
+        if cached_index is not None and cached_index <= num_max:
+            latest_index = find_latest_index(url_pattern,
+                    range(cached_index, min(cached_index + 1, num_max) + 1),
+                    delim=delim)
+        if latest_index is None:
+            metrics_lib.add('cache_misses_total', cache='latest_url_index')
+            latest_index = find_latest_index(url_pattern,
+                    range(1, num_max + 1), delim=delim)
+        else:
+            metrics_lib.add('cache_hits_total', cache='latest_url_index')
+
+        if latest_index is not None:
+            if latest_index != cached_index:
+                with _latest_url_indexes_lock:
+                    latest_indexes = cache_lib.load_json(
+                            LATEST_URL_INDEXES_CACHE_NAME, {})
+                    latest_indexes[url_pattern] = latest_index
+                    cache_lib.save_json(LATEST_URL_INDEXES_CACHE_NAME,
+                            latest_indexes)
+            return http_lib.urlopen(url_pattern.format(delim=delim,
+                num=latest_index))
+    return http_lib.urlopen(url_pattern.format(delim='', num=''))
 
 def get_addon_url_paths(num_max=3):
     """Return a dictionary which maps the addon name to its url from the latest
@@ -118,6 +193,130 @@ def normalize_xmldict(xmldict):
             raise Exception('Element must be a list or a dict')
     return attrdict
 
+def normalize_xml_name(name):
+    return name.replace('sdk:', '', 1).replace('-', '_')
+
+def normalize_xmlvalue(value):
+    """Return the node `value` as parsed by xmltodict with normalized names,
+    using plain dictionaries."""
+    if isinstance(value, dict):
+        return {normalize_xml_name(key): normalize_xmlvalue(subvalue)
+                for key, subvalue in value.items()}
+    elif isinstance(value, list):
+        return [normalize_xmlvalue(subvalue) for subvalue in value]
+    return value
+
+class AndroidRecord(object):
+    """Base of the records built from the android repositories. Fields
+    default to None. Item access on a field which is None raises KeyError, so
+    that records can be walked with the dotted paths of
+    `source_property_mapping`."""
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError('Unexpected fields for {}: {}'.format(
+                type(self).__name__, ', '.join(fields)))
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__))
+
+class AndroidLicense(AndroidRecord):
+    __slots__ = ('name', 'content')
+
+class AndroidRevision(AndroidRecord):
+    __slots__ = ('major', 'minor', 'micro', 'preview')
+
+class AndroidArchive(AndroidRecord):
+    __slots__ = ('url', 'checksum', 'size', 'host_os')
+
+class AndroidPackage(AndroidRecord):
+    """An android package. Nodes of the repository without a field of their
+    own are kept, normalized, in `extras`."""
+    __slots__ = ('package_type', 'package_repo_url', 'api_level', 'codename',
+            'revision', 'version', 'description', 'display_name', 'name_id',
+            'name_display', 'vendor_id', 'vendor_display', 'tag_id',
+            'tag_display', 'abi', 'layoutlib', 'min_tools_rev', 'add_on',
+            'obsolete', 'archives', 'license', 'extras')
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            return self.extras[key]
+
+def make_android_revision(node):
+    """Return the revision node as a string when it is a single number, as
+    an `AndroidRevision` otherwise."""
+    if not isinstance(node, dict):
+        return node
+    return AndroidRevision(**{normalize_xml_name(key): value
+        for key, value in node.items()
+        if normalize_xml_name(key) in AndroidRevision.__slots__})
+
+def make_android_archive_o(node):
+    checksum = node['sdk:checksum']
+    return AndroidArchive(url=node.get('sdk:url'), size=node.get('sdk:size'),
+            checksum={checksum['@type']: checksum['#text']},
+            host_os=get_archive_host_os(node, 'sdk:'))
+
+def make_android_archive_2(node):
+    complete = node['complete']
+    return AndroidArchive(url=complete.get('url'), size=complete.get('size'),
+            checksum={'sha1': complete['checksum']},
+            host_os=get_archive_host_os(node))
+
+def make_android_archives(node, make_archive, prefix=''):
+    """Return the archives of the archives node `node` that can be installed
+    on linux."""
+    archive_key = '{}archive'.format(prefix)
+    if not isinstance(node, dict) or list(node.keys()) != [archive_key]:
+        raise Exception('archives must contain only archive node')
+    return [make_archive(archive)
+            for archive in create_or_return_list(node[archive_key])
+            if get_archive_host_os(archive, prefix) in ('any', 'linux')]
+
+def make_android_package(node, package_type, package_repo_url, make_archive,
+        prefix=''):
+    """Build an `AndroidPackage` from a package node as parsed by
+    xmltodict. The type details of the package are merged in the package."""
+    fields = {'obsolete': False, 'extras': {}}
+
+    def set_field(key, value):
+        name = normalize_xml_name(key)
+        if name == 'archives':
+            fields[name] = make_android_archives(value, make_archive, prefix)
+        elif name == 'uses_license':
+            fields['license'] = AndroidLicense(name=value['@ref'])
+        elif name == 'revision':
+            fields[name] = make_android_revision(value)
+        elif name == 'obsolete':
+            fields[name] = True
+        elif name == 'type_details':
+            # TODO: do not merge type details on the parent node
+            for subkey, subvalue in value.items():
+                set_field(subkey, subvalue)
+        elif name in AndroidPackage.__slots__:
+            fields[name] = normalize_xmlvalue(value)
+        else:
+            fields['extras'][name] = normalize_xmlvalue(value)
+
+    for key, value in node.items():
+        set_field(key, value)
+    fields['package_type'] = package_type
+    fields['package_repo_url'] = package_repo_url
+    return AndroidPackage(**fields)
+
 def android_arch(arch):
     if arch == 'armeabi-v7a':
         return 'armv7a-eabi'
@@ -138,103 +337,216 @@ def get_android_package_name(item):
         package_name = item.package_type
     return package_name.replace('_', '-')
 
+def get_revision_key(revision):
+    """Return a tuple of integers ordering the revisions, which may be an
+    `AndroidRevision` or a single number."""
+    if isinstance(revision, AndroidRevision):
+        return tuple(int(part or 0) for part in (revision.major,
+            revision.minor, revision.micro))
+    return (int(revision),)
+
 def get_android_version(item):
+    """Return a tuple of integers ordering the versions of the item."""
+    if item.api_level is not None:
+        return (int(item.api_level),) + get_revision_key(item.revision)
+    return get_revision_key(item.revision)
+
+def get_archive_host_os(archive_node, prefix=''):
+    """Return the host os of an archive node as parsed by xmltodict or 'any'
+    when the archive is not specific to a host."""
     try:
-        return (int(item.api_level), item.revision)
-    except AttributeError:
-        revision = item.revision
-        try:
-            return (revision.major, revision.minor, revision.micro)
-        except AttributeError:
-            return (int(revision),)
-
-def get_android_items(url_file_objs):
-    items = [];
+        return archive_node['@os']
+    except KeyError:
+        return archive_node.get('{}host-os'.format(prefix), 'any')
+
+def set_android_item_license(itm, licenses):
+    itm.license.content = licenses[itm.license.name]
+
+def get_android_items(url_file_objs, stop_event=None):
+    """Return the items of every android repository in `url_file_objs`.
+    Each repository is streamed to the xml parser and each of its packages is
+    built as an `AndroidPackage` as soon as it is parsed. The parse is
+    interrupted with xmltodict.ParsingInterrupted once the
+    `threading.Event` `stop_event` is set."""
+    items = []
     for android_file_obj in url_file_objs:
-        android_xmldict = xmltodict.parse(android_file_obj.read())
-        nodes = next(iter(android_xmldict.values()))
-
-        if ('repo:sdk-addon' in android_xmldict
-                or 'sys-img:sdk-sys-img' in android_xmldict):
-            get_android_items_2(android_file_obj, android_xmldict, nodes, items)
-        else:
-            get_android_items_o(android_file_obj, android_xmldict, nodes, items)
-
-    return items
-
-def get_android_items_o(android_file_obj, android_xmldict, nodes, items):
-    license_node = create_or_return_list(nodes.pop('sdk:license'))
-    licenses = {node['@id']: node['#text'] for node in license_node}
-
-    for key, value in nodes.items():
-        if not key.startswith('sdk:'):
-            continue
-        name = key.replace('sdk:', '', 1).replace('-', '_')
-        node_list = create_or_return_list(value)
-
-        for subnode in node_list:
-            itm = normalize_xmldict(subnode)
-            itm.package_type = name
-            itm.package_repo_url = android_file_obj.url
-
-            if len(list(itm.archives.keys())) == 1:
-                itm.archives = create_or_return_list(itm.archives.archive)
+        licenses = {}
+        items_by_node_name = collections.OrderedDict()
+
+        def handle_node(path, node):
+            if stop_event is not None and stop_event.is_set():
+                return False
+            root_name, node_name = path[0][0], path[-1][0]
+            if not isinstance(node, dict):
+                return True
+            if root_name in ('repo:sdk-addon', 'sys-img:sdk-sys-img'):
+                get_android_items_2(android_file_obj, root_name, node_name,
+                        node, licenses, items_by_node_name)
             else:
-                raise Exception('archives must contain only archive node')
+                get_android_items_o(android_file_obj, node_name, node,
+                        licenses, items_by_node_name)
+            return True
 
-            for archive in itm.archives:
-                hash_type = archive.checksum['@type']
-                archive.checksum[hash_type] = archive.checksum['#text']
-                del archive.checksum['@type']
-                del archive.checksum['#text']
-
-            license_name = itm.uses_license['@ref']
-            itm.license = AttrDict()
-            itm.license.name = license_name
-            itm.license.content = licenses[license_name]
-            del itm.uses_license
+        xmltodict.parse_fast(android_file_obj, item_depth=2,
+                item_callback=handle_node)
 
+        for itm in itertools.chain.from_iterable(items_by_node_name.values()):
+            set_android_item_license(itm, licenses)
             items.append(itm)
 
-def get_android_items_2(android_file_obj, android_xmldict, nodes, items):
-    license_node = create_or_return_list(nodes.pop('license'))
-    licenses = {node['@id']: node['#text'] for node in license_node}
-    if 'sys-img:sdk-sys-img' in android_xmldict:
-        package_type = 'sys-img'
-    elif 'repo:sdk-addon':
-        package_type = 'addon'
-
-    for key, value in nodes.items():
-        if key != 'remotePackage':
-            continue
-        node_list = create_or_return_list(value)
-
-        for subnode in node_list:
-            itm = normalize_xmldict(subnode)
-            itm.package_type = package_type
-            itm.package_repo_url = android_file_obj.url
+    return items
 
-            if len(list(itm.archives.keys())) == 1:
-                itm.archives = create_or_return_list(itm.archives.archive)
-            else:
-                raise Exception('archives must contain only archive node')
+def parse_android_file(android_file_obj, stop_event=None):
+    """Return the items of the open android repository `android_file_obj`
+    and close it. See `get_android_items` for `stop_event`."""
+    with android_file_obj:
+        return get_android_items([android_file_obj], stop_event)
+
+class AndroidCatalog(object):
+    """The android items indexed by package name, api level and codename.
+    `latest` maps the package names to their latest item and is
+    kept up to date as items are added. Extras and obsolete items are only
+    in `items`, since they are never packaged."""
+    __slots__ = ('items', 'by_package_name', 'by_api_level', 'by_codename',
+            'latest')
+
+    def __init__(self, items=()):
+        self.items = []
+        self.by_package_name = {}
+        self.by_api_level = {}
+        self.by_codename = {}
+        self.latest = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        self.items.append(item)
+        if item.package_type == 'extra' or item.obsolete:
+            return
+        package_name = get_android_package_name(item)
+        self.by_package_name.setdefault(package_name, []).append(item)
+        if item.api_level is not None:
+            self.by_api_level.setdefault(item.api_level, []).append(item)
+        if item.codename is not None:
+            self.by_codename.setdefault(item.codename, []).append(item)
+
+        # Like a stable sort, the first of the items of the same version
+        # is the latest
+        latest = self.latest.get(package_name)
+        if latest is None or (get_android_version(item)
+                > get_android_version(latest)):
+            self.latest[package_name] = item
+
+def open_android_repositories(executor):
+    """Open the latest android repository and all of its addons with
+    `executor`. Return the futures of their file objects, addons first."""
+    repository_future = executor.submit(get_repository_xml_url)
+    futures = [executor.submit(http_lib.urlopen, url)
+        for url in itertools.chain.from_iterable(
+            get_addon_url_paths().values())]
+    futures.append(repository_future)
+    return futures
+
+def get_catalog_snapshot_key(file_objs):
+    """Return the key identifying the content of the android repositories
+    `file_objs` from their validators, or None if one of them has none."""
+    key = [ANDROID_CATALOG_SNAPSHOT_VERSION]
+    for file_obj in file_objs:
+        validators = getattr(file_obj, 'validators', None) or {}
+        if not any(validators.values()):
+            return None
+        key.append((file_obj.url, validators.get('etag'),
+            validators.get('last_modified')))
+    return key
+
+def get_catalog_snapshot_path():
+    return os.path.join(cache_lib.get_cache_dir(),
+            ANDROID_CATALOG_SNAPSHOT_NAME)
+
+def load_catalog_snapshot(key):
+    """Return the `AndroidCatalog` saved for `key` or None."""
+    try:
+        with open(get_catalog_snapshot_path(), 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError, ValueError):
+        return None
+    if snapshot.get('key') != key:
+        return None
+    return snapshot['catalog']
+
+def save_catalog_snapshot(key, catalog):
+    cache_lib.write_atomically(get_catalog_snapshot_path(),
+            pickle.dumps({'key': key, 'catalog': catalog},
+                pickle.HIGHEST_PROTOCOL), 'wb')
+
+def get_android_catalog(max_workers=8):
+    """Return the `AndroidCatalog` of the latest android repository and of
+    all of its addons, which are requested and parsed by at most
+    `max_workers` threads. Each repository is parsed as soon as it is
+    received. When none of the repositories changed since the last catalog
+    was built, as told by their validators, the catalog is loaded from its
+    snapshot instead, and the parses still running are interrupted."""
+    stop_event = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        open_futures = open_android_repositories(executor)
+        parse_futures = {}
+        try:
+            for future in concurrent.futures.as_completed(open_futures):
+                parse_futures[future] = executor.submit(parse_android_file,
+                        future.result(), stop_event)
+
+            key = get_catalog_snapshot_key(
+                    [future.result() for future in open_futures])
+            catalog = None if key is None else load_catalog_snapshot(key)
+            if catalog is not None:
+                metrics_lib.add('cache_hits_total', cache='android_catalog')
+                return catalog
+            metrics_lib.add('cache_misses_total', cache='android_catalog')
+
+            catalog = AndroidCatalog(itertools.chain.from_iterable(
+                parse_futures[future].result() for future in open_futures))
+        finally:
+            stop_event.set()
+            for future in open_futures:
+                parse_future = parse_futures.get(future)
+                if parse_future is not None and not parse_future.cancel():
+                    # parse_android_file closes the file object
+                    continue
+                if not future.cancel() and future.exception() is None:
+                    future.result().close()
+    if key is not None:
+        save_catalog_snapshot(key, catalog)
+    return catalog
+
+def get_android_items_o(android_file_obj, node_name, node, licenses,
+        items_by_node_name):
+    if node_name == 'sdk:license':
+        licenses[node['@id']] = node['#text']
+        return
+    if not node_name.startswith('sdk:'):
+        return
+    name = normalize_xml_name(node_name)
 
-            for archive in itm.archives:
-                archive.checksum = {}
-                archive.checksum['sha1'] = archive.complete.checksum
-                del archive.complete.checksum
+    itm = make_android_package(node, name, android_file_obj.url,
+            make_android_archive_o, 'sdk:')
+    items_by_node_name.setdefault(node_name, []).append(itm)
 
-            # TODO: do not merge type details on the parent node
-            itm.update(itm.type_details)
-            del itm.type_details
-
-            license_name = itm.uses_license['@ref']
-            itm.license = AttrDict()
-            itm.license.name = license_name
-            itm.license.content = licenses[license_name]
-            del itm.uses_license
+def get_android_items_2(android_file_obj, root_name, node_name, node,
+        licenses, items_by_node_name):
+    if node_name == 'license':
+        licenses[node['@id']] = node['#text']
+        return
+    if node_name != 'remotePackage':
+        return
+    if root_name == 'sys-img:sdk-sys-img':
+        package_type = 'sys-img'
+    else:
+        package_type = 'addon'
 
-            items.append(itm)
+    itm = make_android_package(node, package_type, android_file_obj.url,
+            make_android_archive_2)
+    items_by_node_name.setdefault(node_name, []).append(itm)
 
 source_property_mapping = (
         ('abi'                    , 'SystemImage.Abi'),
@@ -294,100 +606,144 @@ def get_android_package_pkgver_vars(item):
     available, '_apilevel' with the api_level if its available, and the
     pkgver."""
     version_variables = {}
-    try:
+    if item.api_level is not None:
         version_variables['_apilevel'] = item.api_level
         version_variables['_rev'] = 'r{:0>2}'.format(int(item.revision))
         version_variables['pkgver'] = '{}_{}'.format(version_variables['_apilevel'],
                 version_variables['_rev'])
-    except AttributeError:
+    else:
         revision = item.revision
         version_variables['_rev'] = '{}.{}.{}'.format(revision.major, revision.minor, revision.micro)
         version_variables['pkgver'] = '{}'.format(version_variables['_rev'])
     return version_variables
 
 
-def update_package(run, src_path, item):
+def get_latest_packages(catalog, exclude_codename=None):
+    """Return a dictionary mapping the name of the android packages of the
+    `AndroidCatalog` to their latest item, leaving out the items of
+    `exclude_codename`."""
+    if exclude_codename is None:
+        return dict(catalog.latest)
+
+    latest_packages = {}
+    for package_name, items in catalog.by_package_name.items():
+        pkgs = [itm for itm in items if itm.codename != exclude_codename]
+        if pkgs:
+            latest_packages[package_name] = max(pkgs,
+                    key=get_android_version)
+    return latest_packages
+
+def fetch(job):
+    # The items were fetched when discovering the packages
+    if not os.path.isdir(job.src_path):
+        job.status = 'not maintained'
+        return None
     # Skip package when the host os is not compatible with linux
-    for archive in item.archives:
+    for archive in job.upstream.archives:
+        if archive.host_os in ('any', 'linux'):
+            job.data['archive'] = archive
+            return job
+    job.status = 'no linux archive'
+    return None
+
+def parse(job):
+    with metrics_lib.timed(job.timings, 'parse'):
+        android_pkgver_vars = get_android_package_pkgver_vars(job.upstream)
+        job.upstream_version = android_pkgver_vars.pop('pkgver')
+        job.data['pkgver_vars'] = android_pkgver_vars
+        job.upstream_checksum = ':'.join(next(iter(
+            job.data['archive'].checksum.items())))
+        return pipeline_lib.parse_unless_unchanged(job)
+
+def compare(job):
+    with metrics_lib.timed(job.timings, 'compare'):
+        pkgbuild = job.pkgbuild
+        android_pkgver_vars = job.data['pkgver_vars']
+        has_update = False
         try:
-            host_os = archive['@os']
-        except KeyError:
-            try:
-                host_os = archive.host_os
-            except AttributeError:
-                host_os = 'any'
-
-        if host_os in ('any', 'linux'):
-            break
-    else:
-        return
-
-    pkgbuild_path = os.path.join(src_path, 'PKGBUILD')
-    with open(pkgbuild_path, 'r') as pkgbuild:
-        pkgbuild_content = pkgbuild.read()
-
-    pkgname = pkgbuild_lib.get_pkgbuild_value(pkgbuild_content, 'pkgname')
-
-    android_pkgver_vars = get_android_package_pkgver_vars(item)
-    android_pkgver = android_pkgver_vars['pkgver']
-    del android_pkgver_vars['pkgver']
-
-    has_update = False
-    try:
-        pkgbuild_apilevel = pkgbuild_lib.get_pkgbuild_value(pkgbuild_content, '_apilevel')
-        has_update = has_update or pkgbuild_lib.vercmp(run, pkgbuild_apilevel,
-            android_pkgver_vars['_apilevel']) < 0
-    except ValueError:
-        pass
-
-    pkgbuild_rev = pkgbuild_lib.get_pkgbuild_value(pkgbuild_content, '_rev')
-    has_update = has_update or pkgbuild_lib.vercmp(run, pkgbuild_rev,
-            android_pkgver_vars['_rev']) < 0
-
+            pkgbuild_apilevel = pkgbuild.get_value('_apilevel')
+            has_update = has_update or pkgbuild_lib.vercmp(pkgbuild_apilevel,
+                android_pkgver_vars['_apilevel']) < 0
+        except ValueError:
+            pass
+
+        pkgbuild_rev = pkgbuild.get_value('_rev')
+        has_update = has_update or pkgbuild_lib.vercmp(pkgbuild_rev,
+                android_pkgver_vars['_rev']) < 0
     if not has_update:
-        print('{} already updated'.format(pkgname))
-        return
-
-    checksum_algo_name, checksum_algo_res = list(archive.checksum.items())[0]
-
-    source_properties_filename = 'source.properties'
-    source_properties_path = os.path.join(src_path, source_properties_filename)
-    source_properties_list = []
-    source_properties_hash_list = []
-    if os.path.exists(source_properties_path):
-        source_properties = get_source_properties(item)
-        source_properties_hash = hashlib.new(checksum_algo_name)
-        source_properties_hash.update(bytes(source_properties, 'utf8'))
-        source_properties_hash = source_properties_hash.hexdigest()
-
-        source_properties_list.append(source_properties_filename)
-        source_properties_hash_list.append(source_properties_hash)
-
-
-    for varname, value in android_pkgver_vars.items():
-        pkgbuild_content = pkgbuild_lib.replace_pkgbuild_var_value(
-                pkgbuild_content, varname, value)
-    pkgbuild_content = pkgbuild_lib.replace_pkgbuild_var_value(
-            pkgbuild_content, 'pkgrel', '1')
-
-    pkgsource = [urllib.parse.urljoin(item.package_repo_url, archive.url)]
-    pkgsums = [checksum_algo_res]
-
-    pkgsource.extend(source_properties_list)
-    pkgsums.extend(source_properties_hash_list)
-
-    for varname, values in zip(['source',
-        '{}sums'.format(checksum_algo_name)], [pkgsource, pkgsums]):
-        bash_array, array_pattern = pkgbuild_lib.extract_array_var_pattern(
-            pkgbuild_content, varname)
-        pkgbuild_content = pkgbuild_content.replace(bash_array,
-                array_pattern.format(*values))
-
-    with open(pkgbuild_path, 'w') as pkgbuild:
-        pkgbuild.write(pkgbuild_content)
-
-    if source_properties_list:
-        with open(source_properties_path, 'w') as f:
-            f.write(source_properties)
-    pkgbuild_lib.commit_pkgbuild(run, src_path,
-            pkgname, android_pkgver, source_properties_list)
+        return pipeline_lib.set_up_to_date(job)
+    return job
+
+def rewrite(job):
+    with metrics_lib.timed(job.timings, 'rewrite'):
+        item, archive = job.upstream, job.data['archive']
+        pkgbuild = job.pkgbuild
+        checksum_algo_name, checksum_algo_res = list(archive.checksum.items())[0]
+
+        files = collections.OrderedDict()
+        source_properties_filename = 'source.properties'
+        source_properties_path = os.path.join(job.src_path,
+                source_properties_filename)
+        source_properties_list = []
+        source_properties_hash_list = []
+        if os.path.exists(source_properties_path):
+            source_properties = get_source_properties(item)
+            source_properties_hash = hashlib.new(checksum_algo_name)
+            source_properties_hash.update(bytes(source_properties, 'utf8'))
+            source_properties_hash = source_properties_hash.hexdigest()
+
+            source_properties_list.append(source_properties_filename)
+            source_properties_hash_list.append(source_properties_hash)
+            files[source_properties_filename] = source_properties
+
+        for varname, value in job.data['pkgver_vars'].items():
+            pkgbuild.set_value(varname, value)
+        pkgbuild.set_value('pkgrel', '1')
+
+        pkgsource = [urllib.parse.urljoin(item.package_repo_url, archive.url)]
+        pkgsums = [checksum_algo_res]
+        job.sources = [verify_lib.make_source_file(pkgsource[0],
+            {checksum_algo_name: checksum_algo_res})]
+
+        pkgsource.extend(source_properties_list)
+        pkgsums.extend(source_properties_hash_list)
+
+        for varname, values in zip(['source',
+            '{}sums'.format(checksum_algo_name)], [pkgsource, pkgsums]):
+            pkgbuild.set_array_values(varname, values)
+        files['PKGBUILD'] = pkgbuild.render()
+        return pipeline_lib.plan_update(job, files)
+
+def make_pipeline_source(src_parent, exclude_codename=None, max_workers=8,
+        dry_run=False):
+    """Return the `pipeline_lib.PipelineSource` of the android packages
+    whose PKGBUILDs are in `src_parent`. Discovering the packages fetches
+    every android repository with at most `max_workers` threads. Packages
+    without a PKGBUILD directory in `src_parent` end with the status 'not
+    maintained'."""
+    def discover():
+        timings = collections.OrderedDict()
+        with metrics_lib.timed(timings, 'fetch'):
+            catalog = get_android_catalog(max_workers)
+        with metrics_lib.timed(timings, 'select'):
+            latest_packages = get_latest_packages(catalog, exclude_codename)
+        if dry_run:
+            print('android repositories: {}'.format(
+                pkgbuild_lib.format_timings(timings)))
+        for package_name, item in latest_packages.items():
+            src_path = os.path.join(src_parent,
+                    to_aur_package_name(package_name))
+            yield pipeline_lib.PackageJob(source, src_path, item, dry_run)
+    source = pipeline_lib.PipelineSource('android', discover, fetch, parse,
+            compare, rewrite)
+    return source
+
+def update_package(src_path, item, dry_run=False, verify=False):
+    """Update the PKGBUILD in `src_path` to the android package `item` and
+    commit it. Return the `pkgbuild_lib.PkgbuildUpdate` or None if the
+    package is already updated. When `dry_run` is true, nothing is written
+    nor committed. When `verify` is true, the archive is downloaded and
+    checked against its checksum first."""
+    source = make_pipeline_source(os.path.dirname(src_path))
+    return pipeline_lib.run_job(pipeline_lib.PackageJob(source, src_path,
+        item, dry_run), verify)
@@ -0,0 +1,432 @@
+"""Offline benchmarks of the parse, compare and rewrite hot paths.
+
+The fixtures are generated from templates shaped like the real upstream
+documents, so the suite never touches the network. Each benchmark reports
+its median wall time and its peak memory, and `check_regressions` compares
+them with the baseline stored in `benchmark_baseline.json`."""
+import android_repository_lib as android_repo_lib
+import collections
+import dsc_lib
+import io
+import json
+import os
+import pickle
+import pkgbuild_lib
+import pypi_lib
+import statistics
+import sys
+import time
+import tracemalloc
+import xmltodict
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'benchmark_baseline.json')
+# Wall times vary more between runs than peak memory does. The median of
+# DEFAULT_REPEAT runs is stable enough for a 30% margin.
+TOLERANCES = {'seconds': 0.3, 'peak_bytes': 0.2}
+DEFAULT_REPEAT = 11
+
+Benchmark = collections.namedtuple('Benchmark', ['name', 'setup'])
+BenchmarkResult = collections.namedtuple('BenchmarkResult',
+        ['name', 'seconds', 'peak_bytes'])
+
+BENCHMARKS = []
+
+
+def benchmark(setup):
+    """Register a benchmark. `setup` builds the fixtures and returns the
+    function to measure."""
+    BENCHMARKS.append(Benchmark(setup.__name__.replace('bench_', '', 1),
+        setup))
+    return setup
+
+
+class NamedBytesIO(io.BytesIO):
+    """A file object for a fixture, carrying a url like a response."""
+    def __init__(self, content, url):
+        super().__init__(content)
+        self.url = url
+
+
+def make_repository_xml(num_platforms=400):
+    """Return a repository-12.xml like document."""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<sdk:sdk-repository xmlns:sdk='
+            '"http://schemas.android.com/sdk/android/repository/12">\n'
+            '<sdk:license id="android-sdk-license" type="text">{}'
+            '</sdk:license>\n'.format('Terms and conditions. ' * 200)]
+    for i in range(num_platforms):
+        parts.append('''<sdk:platform>
+  <sdk:version>{major}.0</sdk:version>
+  <sdk:api-level>{i}</sdk:api-level>
+  <sdk:codename></sdk:codename>
+  <sdk:revision>{rev}</sdk:revision>
+  <sdk:description>Android SDK Platform {major}.0</sdk:description>
+  <sdk:min-tools-rev><sdk:major>22</sdk:major></sdk:min-tools-rev>
+  <sdk:layoutlib><sdk:api>15</sdk:api><sdk:revision>1</sdk:revision></sdk:layoutlib>
+  <sdk:uses-license ref="android-sdk-license"/>
+  <sdk:archives>
+    <sdk:archive>
+      <sdk:size>75000000</sdk:size>
+      <sdk:checksum type="sha1">{sha1:040x}</sdk:checksum>
+      <sdk:url>platform-{i}_r{rev:02}.zip</sdk:url>
+    </sdk:archive>
+  </sdk:archives>
+</sdk:platform>
+<sdk:build-tool>
+  <sdk:revision><sdk:major>{i}</sdk:major><sdk:minor>0</sdk:minor><sdk:micro>{rev}</sdk:micro></sdk:revision>
+  <sdk:uses-license ref="android-sdk-license"/>
+  <sdk:archives>
+'''.format(i=i, major=i // 4, rev=i % 7 + 1, sha1=i))
+        for host_os in ('linux', 'macosx', 'windows'):
+            parts.append('''    <sdk:archive>
+      <sdk:size>48000000</sdk:size>
+      <sdk:checksum type="sha1">{sha1:040x}</sdk:checksum>
+      <sdk:url>build-tools_r{i}-{host_os}.zip</sdk:url>
+      <sdk:host-os>{host_os}</sdk:host-os>
+    </sdk:archive>
+'''.format(i=i, host_os=host_os, sha1=i * 3))
+        parts.append('  </sdk:archives>\n</sdk:build-tool>\n')
+    parts.append('</sdk:sdk-repository>\n')
+    return ''.join(parts).encode('utf-8')
+
+def make_repository2_xml(root='sys-img:sdk-sys-img', num_packages=1000):
+    """Return a sys-img2 or addon2 like document."""
+    namespace = root.split(':')[0]
+    parts = ['<?xml version="1.0" ?>\n'
+            '<{root} xmlns:{namespace}="http://schemas.android.com/sdk/'
+            'android/repo/{namespace}2/01" xmlns:xsi='
+            '"http://www.w3.org/2001/XMLSchema-instance">\n'
+            '<license id="android-sdk-license" type="text">{terms}</license>\n'
+            .format(root=root, namespace=namespace,
+                terms='Terms and conditions. ' * 200)]
+    for i in range(num_packages):
+        parts.append('''<remotePackage path="system-images;android-{i};default;x86">
+  <type-details xsi:type="{namespace}:detailsType">
+    <api-level>{i}</api-level>
+    <tag><id>default</id><display>Default</display></tag>
+    <vendor><id>google</id><display>Google Inc.</display></vendor>
+    <abi>x86</abi>
+  </type-details>
+  <revision><major>{rev}</major><minor>0</minor><micro>0</micro></revision>
+  <display-name>Intel x86 Atom System Image</display-name>
+  <uses-license ref="android-sdk-license"/>
+  <archives>
+    <archive>
+      <complete><size>1</size><checksum>{sha1:040x}</checksum><url>x86-{i}_r{rev:02}.zip</url></complete>
+      <host-os>linux</host-os>
+    </archive>
+    <archive>
+      <complete><size>1</size><checksum>{sha1:040x}</checksum><url>x86-{i}_r{rev:02}-windows.zip</url></complete>
+      <host-os>windows</host-os>
+    </archive>
+  </archives>
+</remotePackage>
+'''.format(i=i, rev=i % 9 + 1, sha1=i, namespace=namespace))
+    parts.append('</{}>\n'.format(root))
+    return ''.join(parts).encode('utf-8')
+
+def make_pypi_json(num_releases=3000):
+    """Return a /pypi/<name>/json like document."""
+    releases = {}
+    for i in range(num_releases):
+        version = '{}.{}.{}'.format(i // 100, i // 10 % 10, i % 10)
+        releases[version] = [{
+            'packagetype': packagetype,
+            'filename': 'PyHamcrest-{}{}'.format(version, suffix),
+            'md5_digest': '{:032x}'.format(i),
+            'digests': {'md5': '{:032x}'.format(i),
+                'sha256': '{:064x}'.format(i)},
+            'size': 1000 + i,
+            'url': 'https://files.pythonhosted.org/PyHamcrest-{}{}'.format(
+                version, suffix),
+        } for packagetype, suffix in (('sdist', '.tar.gz'),
+            ('bdist_wheel', '-py2.py3-none-any.whl'))]
+    return json.dumps({'info': {'version': version}, 'releases': releases})
+
+def make_dsc(num_files=40):
+    """Return a .dsc with several checksum fields."""
+    lines = ['Format: 3.0 (quilt)', 'Source: xapian-omega',
+            'Version: 1.4.0-1']
+    for name, width in (('Sha1', 40), ('Sha256', 64), ('Sha512', 128)):
+        lines.append('Checksums-{}:'.format(name))
+        for i in range(num_files):
+            lines.append(' {:0{}x} {} xapian-omega_1.4.{}.orig.tar.xz'.format(
+                i, width, 1000 + i, i))
+    lines.append('Files:')
+    for i in range(num_files):
+        lines.append(' {:032x} {} xapian-omega_1.4.{}.orig.tar.xz'.format(
+            i, 1000 + i, i))
+    return '\n'.join(lines) + '\n'
+
+def make_pkgbuilds():
+    """Return PKGBUILDs of the shapes maintained in the aur packages."""
+    pkgbuilds = []
+    for i in range(200):
+        quote = ('', '"', "'")[i % 3]
+        num_sources = i % 4 + 1
+        lines = ['# Maintainer: Someone <someone@example.com>',
+                'pkgname=android-platform-{}'.format(i),
+                '_apilevel={q}{}{q}'.format(i, q=quote),
+                '_rev={q}r{:02}{q}'.format(i % 9, q=quote),
+                'pkgver=${_apilevel}_${_rev}',
+                'pkgrel=1',
+                'pkgdesc="Android SDK Platform, API-{}"'.format(i),
+                "arch=('any')",
+                'source=({})'.format('\n        '.join(
+                    '"https://dl.google.com/{}-${{pkgver}}.zip"'.format(j)
+                    for j in range(num_sources))),
+                'sha1sums=({})'.format('\n          '.join(
+                    "'{:040x}'".format(j) for j in range(num_sources))),
+                'package() {',
+                '  mkdir -p "${pkgdir}/opt/android-sdk/platforms/"',
+                '  cp -dpr --no-preserve=ownership "${srcdir}/x" "${pkgdir}"',
+                '}']
+        lines[12:12] = ['# padding {}'.format(j) for j in range(i % 50)]
+        pkgbuilds.append(('\n'.join(lines) + '\n', num_sources))
+    return pkgbuilds
+
+
+@benchmark
+def bench_xmltodict_parse_repository():
+    content = make_repository_xml()
+    return lambda: xmltodict.parse(content)
+
+@benchmark
+def bench_xmltodict_parse_sys_img2():
+    content = make_repository2_xml()
+    return lambda: xmltodict.parse(content)
+
+@benchmark
+def bench_xmltodict_parse_fast_repository():
+    content = make_repository_xml()
+    return lambda: xmltodict.parse_fast(content)
+
+@benchmark
+def bench_xmltodict_parse_fast_sys_img2():
+    content = make_repository2_xml()
+    return lambda: xmltodict.parse_fast(content)
+
+@benchmark
+def bench_normalize_xmldict():
+    nodes = xmltodict.parse(make_repository_xml())['sdk:sdk-repository']
+    nodes = nodes['sdk:platform'] + nodes['sdk:build-tool']
+    return lambda: [android_repo_lib.normalize_xmldict(node) for node in nodes]
+
+@benchmark
+def bench_make_android_package():
+    nodes = xmltodict.parse(make_repository_xml())['sdk:sdk-repository']
+    nodes = nodes['sdk:platform'] + nodes['sdk:build-tool']
+    return lambda: [android_repo_lib.make_android_package(node, 'platform',
+        'https://example.com/', android_repo_lib.make_android_archive_o,
+        'sdk:') for node in nodes]
+
+@benchmark
+def bench_attrdict_field_access():
+    nodes = xmltodict.parse(make_repository_xml())['sdk:sdk-repository']
+    items = [android_repo_lib.normalize_xmldict(node)
+            for node in nodes['sdk:platform']]
+    def run():
+        for _ in range(20):
+            for item in items:
+                item.api_level, item.revision, item.description
+    return run
+
+@benchmark
+def bench_record_field_access():
+    nodes = xmltodict.parse(make_repository_xml())['sdk:sdk-repository']
+    items = [android_repo_lib.make_android_package(node, 'platform',
+        'https://example.com/', android_repo_lib.make_android_archive_o,
+        'sdk:') for node in nodes['sdk:platform']]
+    def run():
+        for _ in range(20):
+            for item in items:
+                item.api_level, item.revision, item.description
+    return run
+
+@benchmark
+def bench_get_android_items_repository():
+    content = make_repository_xml()
+    return lambda: android_repo_lib.get_android_items(
+            [NamedBytesIO(content, 'https://example.com/repository-12.xml')])
+
+@benchmark
+def bench_get_android_items_sys_img2():
+    content = make_repository2_xml()
+    return lambda: android_repo_lib.get_android_items(
+            [NamedBytesIO(content, 'https://example.com/sys-img.xml')])
+
+@benchmark
+def bench_get_android_items_addon2():
+    content = make_repository2_xml(root='repo:sdk-addon')
+    return lambda: android_repo_lib.get_android_items(
+            [NamedBytesIO(content, 'https://example.com/addon.xml')])
+
+@benchmark
+def bench_android_catalog_build():
+    items = android_repo_lib.get_android_items([NamedBytesIO(
+        make_repository_xml(), 'https://example.com/repository-12.xml')])
+    return lambda: android_repo_lib.AndroidCatalog(items)
+
+@benchmark
+def bench_android_catalog_snapshot_load():
+    items = android_repo_lib.get_android_items([NamedBytesIO(
+        make_repository_xml(), 'https://example.com/repository-12.xml')])
+    content = pickle.dumps(android_repo_lib.AndroidCatalog(items),
+            pickle.HIGHEST_PROTOCOL)
+    return lambda: pickle.loads(content)
+
+@benchmark
+def bench_pkgbuild_regex_rewrite():
+    pkgbuilds = make_pkgbuilds()
+    def run():
+        for content, num_sources in pkgbuilds:
+            pkgbuild_lib.get_pkgbuild_value(content, 'pkgname')
+            pkgbuild_lib.get_pkgbuild_value(content, '_rev')
+            for var_name, value in (('_apilevel', '30'), ('_rev', 'r01'),
+                    ('pkgrel', '1')):
+                content = pkgbuild_lib.replace_pkgbuild_var_value(content,
+                        var_name, value)
+            for var_name in ('source', 'sha1sums'):
+                bash_array, array_pattern = (
+                        pkgbuild_lib.extract_array_var_pattern(content,
+                            var_name))
+                content = content.replace(bash_array,
+                        array_pattern.format(*['x'] * num_sources))
+    return run
+
+@benchmark
+def bench_pkgbuild_document_rewrite():
+    pkgbuilds = make_pkgbuilds()
+    def run():
+        for content, num_sources in pkgbuilds:
+            pkgbuild = pkgbuild_lib.PkgbuildDocument(content)
+            pkgbuild.get_value('pkgname')
+            pkgbuild.get_value('_rev')
+            for var_name, value in (('_apilevel', '30'), ('_rev', 'r01'),
+                    ('pkgrel', '1')):
+                pkgbuild.set_value(var_name, value)
+            for var_name in ('source', 'sha1sums'):
+                pkgbuild.set_array_values(var_name, ['x'] * num_sources)
+            pkgbuild.render()
+    return run
+
+@benchmark
+def bench_dsc_get_checksums():
+    content = make_dsc()
+    names = ['xapian-omega_1.4.{}.orig.tar.xz'.format(i) for i in range(40)]
+    return lambda: [dsc_lib.get_checksums(content, name) for name in names]
+
+@benchmark
+def bench_pypi_json_get_checksums():
+    content = make_pypi_json()
+    def run():
+        pypi_pkg = json.loads(content)
+        for release in pypi_pkg['releases'][pypi_pkg['info']['version']]:
+            pypi_lib.get_checksums(release)
+    return run
+
+@benchmark
+def bench_vercmp_key_sort():
+    versions = ['{}.{}.{}-{}'.format(i % 7, i % 13, i % 101, i % 3 + 1)
+            for i in range(5000)]
+    def run():
+        pkgbuild_lib.vercmp_key.cache_clear()
+        sorted(versions, key=pkgbuild_lib.vercmp_key)
+    return run
+
+
+def measure(func, repeat=DEFAULT_REPEAT):
+    """Return the median wall time of `repeat` calls of `func` and the peak
+    memory allocated by one call."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    seconds = statistics.median(times)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak_bytes
+
+def run_benchmarks(names=None, repeat=DEFAULT_REPEAT):
+    """Run the registered benchmarks, or those in `names`, and return their
+    `BenchmarkResult`."""
+    results = []
+    for bench in BENCHMARKS:
+        if names and bench.name not in names:
+            continue
+        seconds, peak_bytes = measure(bench.setup(), repeat)
+        results.append(BenchmarkResult(bench.name, seconds, peak_bytes))
+    return results
+
+def load_baseline(path=BASELINE_PATH):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_baseline(results, path=BASELINE_PATH):
+    """Store `results` in the baseline, keeping the baseline of the
+    benchmarks that were not run."""
+    baseline = load_baseline(path)
+    baseline.update((result.name, {'seconds': result.seconds,
+        'peak_bytes': result.peak_bytes}) for result in results)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def check_regressions(results, baseline, tolerances=TOLERANCES):
+    """Return a message for every result slower or bigger than its baseline
+    by more than the fraction of the baseline given in `tolerances`, and for
+    every result without a baseline, which cannot be checked."""
+    regressions = []
+    for result in results:
+        if result.name not in baseline:
+            regressions.append('{}: no baseline'.format(result.name))
+            continue
+        for field, tolerance in sorted(tolerances.items()):
+            limit = baseline[result.name][field] * (1 + tolerance)
+            value = getattr(result, field)
+            if value > limit:
+                regressions.append('{}: {} is {:.4g}, baseline {:.4g}'.format(
+                    result.name, field, value, baseline[result.name][field]))
+    return regressions
+
+def format_result(result, baseline):
+    line = '{:<36} {:>10.2f} ms {:>10.1f} KiB'.format(result.name,
+            result.seconds * 1000, result.peak_bytes / 1024)
+    if result.name in baseline:
+        line = '{} ({:+.0%} time, {:+.0%} memory)'.format(line,
+            result.seconds / baseline[result.name]['seconds'] - 1,
+            result.peak_bytes / baseline[result.name]['peak_bytes'] - 1)
+    return line
+
+def main(names=None, update_baseline=False, tolerances=TOLERANCES,
+        repeat=DEFAULT_REPEAT):
+    """Run the benchmarks and print their results. Return 1 if any of them
+    regressed compared with the baseline, 0 otherwise."""
+    baseline = load_baseline()
+    results = run_benchmarks(names, repeat)
+    for result in results:
+        print(format_result(result, baseline))
+
+    if update_baseline:
+        save_baseline(results)
+        return 0
+    regressions = check_regressions(results, baseline, tolerances)
+    for regression in regressions:
+        print('REGRESSION {}'.format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:] or None,
+        update_baseline='AUR_TOOLS_UPDATE_BASELINE' in os.environ))
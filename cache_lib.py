@@ -0,0 +1,45 @@
+import json
+import os
+import tempfile
+
+
+def get_cache_dir(*subdirs):
+    """Return the directory in which aur-tools keeps the data it persists
+    between runs, creating it if needed. The directory is `$AUR_TOOLS_CACHE_DIR`
+    if set, `$XDG_CACHE_HOME/aur-tools` otherwise. `subdirs` are joined to
+    the returned path."""
+    cache_dir = os.environ.get('AUR_TOOLS_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME',
+            os.path.join(os.path.expanduser('~'), '.cache')), 'aur-tools')
+    cache_dir = os.path.join(cache_dir, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def write_atomically(path, data, mode='w'):
+    """Write `data` to `path` so that readers see either the old or the new
+    content, never a partially written file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+            prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def load_json(name, default=None):
+    """Return the json document persisted under `name` or `default` if it
+    does not exist or cannot be decoded."""
+    path = os.path.join(get_cache_dir(), name)
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+def save_json(name, obj):
+    """Persist `obj` as a json document under `name`."""
+    path = os.path.join(get_cache_dir(), name)
+    write_atomically(path, json.dumps(obj, indent=2, sort_keys=True))
@@ -1,69 +1,339 @@
-from urllib.request import urlopen
+from http_lib import urlopen
+import cache_lib
+import collections
+import fetch_lib
+import ftplib
+import gzip
+import io
+import itertools
+import lzma
+import metrics_lib
 import os
+import pipeline_lib
 import pkgbuild_lib
 import re
+import state_lib
+import threading
+import urllib.error
 import urllib.parse
+import verify_lib
+
+
+LATEST_DSC_CACHE_NAME = 'latest-dsc.json'
+DEBIAN_MIRROR_URL = 'https://deb.debian.org/debian/'
+SOURCES_INDEX_OPENERS = {
+        '.xz': lzma.open,
+        '.gz': gzip.open,
+}
+DSC_HREF_PATTERN = re.compile(r'href="([^"/?#]+\.dsc)"')
+
+# Logged in FTP connections by host, reused by the following calls
+_ftp_connections = {}
+_ftp_lock = threading.Lock()
+
+# Sources indexes already parsed by this process, by url
+_sources_indexes = {}
+_sources_indexes_lock = threading.Lock()
+
+SourcePackage = collections.namedtuple('SourcePackage',
+        ['name', 'version', 'dsc_url'])
 
 
 def get_version(dsc_content):
     return re.search(r'{}\s+([^\s]+)'.format('Version:'),
         dsc_content).group(1)
 
+def get_checksum_line_pattern(package_source_name):
+    """Return the pattern of the line of a Checksums field of a dsc for the
+    file whose name starts with `package_source_name`, capturing the
+    checksum, the size and the file name."""
+    return re.compile(r'([^\s]+)\s+([^\s]+)\s+({}[^\s]*)'.format(
+        re.escape(package_source_name)))
+
 def get_checksums(dsc_content, package_source_name):
     checksums = {}
     field_name_pattern = r'{}([^:]+):'.format(re.escape('Checksums-'))
+    pat = get_checksum_line_pattern(package_source_name)
     for match in re.finditer(field_name_pattern , dsc_content):
         start_pos = match.span()[1]
         checksum_name = match.group(1)
-        pat = re.compile(r'([^\s]+)\s+([^\s]+)\s+{}'.format(
-            re.escape(package_source_name)))
         checksums[checksum_name] = pat.search(dsc_content, start_pos).group(1)
     return checksums
 
-def get_dsc_url_from_debian_package_page(package_name):
-    debian_package_page = 'https://packages.debian.org/sid/{}'.format(
-            package_name)
-    with urlopen(debian_package_page) as page:
-        page_content = page.read().decode('utf-8')
-        res = re.search('http((?:(?!\.dsc).)+)\.dsc', page_content)
-        url_dsc = res.group()
-    return url_dsc
-
-def update_package_with_dsc(run, pkgbuild_dir, dsc_url, package_source_name_pattern):
-    with urlopen(dsc_url) as dsc:
-        dsc_content = dsc.read().decode('utf-8')
-    version = re.search(r'{}\s+([^\s]+)'.format('Version:'),
-        dsc_content).group(1)
-    new_pkgver = version.rsplit('-', 1)[0]
-
-    pkgbuild_path = os.path.join(pkgbuild_dir, 'PKGBUILD')
-    with open(pkgbuild_path, 'r') as pkgbuild:
-        pkgbuild_content = pkgbuild.read()
-
-    pkgname = pkgbuild_lib.get_pkgbuild_value(pkgbuild_content, 'pkgname')
-    pkgver = pkgbuild_lib.get_pkgbuild_value(pkgbuild_content, 'pkgver')
-    vercmp_res = pkgbuild_lib.vercmp(run, pkgver, new_pkgver)
-    if vercmp_res >= 0:
-        print('{} already updated'.format(pkgname))
-        return
-
-    pkgbuild_content = pkgbuild_lib.replace_pkgbuild_var_value(
-            pkgbuild_content, 'pkgver', new_pkgver)
-    pkgbuild_content = pkgbuild_lib.replace_pkgbuild_var_value(
-            pkgbuild_content, 'pkgrel', '1')
-
-    package_source_name = package_source_name_pattern.format(new_pkgver)
-    checksums = get_checksums(dsc_content, package_source_name)
-    for checksum_name, value in checksums.items():
+def get_source_file_name(dsc_content, package_source_name):
+    """Return the name of the file of the dsc whose name starts with
+    `package_source_name`, as listed in its first Checksums field, or None
+    if the dsc has no Checksums field."""
+    match = re.search(re.escape('Checksums-'), dsc_content)
+    if match is None:
+        return None
+    return get_checksum_line_pattern(package_source_name).search(
+            dsc_content, match.end()).group(3)
+
+def get_latest_dsc_name(names):
+    """Return the name of the latest version among the .dsc in `names` or
+    None if there is none."""
+    return max((name for name in names if name.endswith('.dsc')),
+            key=pkgbuild_lib.vercmp_key, default=None)
+
+def get_cached_latest_dsc(key, stamp):
+    """Return the latest .dsc name cached for `key` if it was cached when the
+    listing had the same `stamp`."""
+    cached = cache_lib.load_json(LATEST_DSC_CACHE_NAME, {}).get(key)
+    if cached is not None and stamp is not None and cached['stamp'] == stamp:
+        metrics_lib.add('cache_hits_total', cache='dsc_listing')
+        return cached['name']
+    metrics_lib.add('cache_misses_total', cache='dsc_listing')
+    return None
+
+def set_cached_latest_dsc(key, stamp, name):
+    latest_dscs = cache_lib.load_json(LATEST_DSC_CACHE_NAME, {})
+    latest_dscs[key] = {'stamp': stamp, 'name': name}
+    cache_lib.save_json(LATEST_DSC_CACHE_NAME, latest_dscs)
+
+def get_latest_dsc_name_over_http(directory_url):
+    """Return the name of the latest .dsc in the index page of
+    `directory_url`. The page is requested conditionally, so an unchanged
+    directory is answered from the cache without parsing the page."""
+    with urlopen(directory_url) as index:
+        stamp = index.validators if any(index.validators.values()) else None
+        name = get_cached_latest_dsc(directory_url, stamp)
+        if name is None:
+            # The page is searched line by line instead of being decoded
+            # whole
+            lines = io.TextIOWrapper(index, 'utf-8', 'replace')
+            name = get_latest_dsc_name(urllib.parse.unquote(href)
+                    for line in lines
+                    for href in DSC_HREF_PATTERN.findall(line))
+    if stamp is not None and name is not None:
+        set_cached_latest_dsc(directory_url, stamp, name)
+    return name
+
+def get_ftp_connection(host):
+    """Return a logged in FTP connection to `host`, reusing the one of the
+    previous call if it is still alive. Must be called with `_ftp_lock`
+    held."""
+    ftp = _ftp_connections.get(host)
+    if ftp is not None:
         try:
-            bash_array, array_pattern = pkgbuild_lib.extract_array_var_pattern(
-                pkgbuild_content, '{}sums'.format(checksum_name.lower()))
-            pkgbuild_content = pkgbuild_content.replace(bash_array,
-                    array_pattern.format(value))
-        except (ValueError, StopIteration):
-            pass
-
-    with open(pkgbuild_path, 'w') as pkgbuild:
-        pkgbuild.write(pkgbuild_content)
-    pkgbuild_lib.commit_pkgbuild(run, pkgbuild_dir,
-            pkgname, new_pkgver, [])
+            ftp.voidcmd('NOOP')
+            return ftp
+        except (ftplib.Error, OSError, EOFError):
+            ftp.close()
+    ftp = ftplib.FTP(host, timeout=fetch_lib.get_timeout())
+    ftp.login()
+    _ftp_connections[host] = ftp
+    return ftp
+
+def get_ftp_modify_time(ftp, path):
+    """Return the modification time of `path` given by MLST or None if the
+    server does not support it."""
+    try:
+        facts = ftp.sendcmd('MLST {}'.format(path)).splitlines()[1]
+    except (ftplib.error_perm, IndexError):
+        return None
+    for fact in facts.strip().split(';'):
+        name, _, value = fact.partition('=')
+        if name.lower() == 'modify':
+            return value
+    return None
+
+def list_ftp_directory(ftp, directory):
+    """Return the names in `directory`, listed with MLSD when the server
+    supports it and NLST otherwise."""
+    try:
+        return [name for name, facts in ftp.mlsd(directory, facts=['type'])
+                if facts.get('type') == 'file']
+    except ftplib.error_perm:
+        return [name.rsplit('/', 1)[-1] for name in ftp.nlst(directory)]
+
+def get_latest_dsc_name_over_ftp(host, directory):
+    """Return the name of the latest .dsc in `directory` of the FTP server
+    at `host`. The directory is listed only when its MLST modification time
+    changed since the previous listing."""
+    key = 'ftp://{}/{}'.format(host, directory)
+    with _ftp_lock:
+        fetch_lib.check_deadline()
+        ftp = get_ftp_connection(host)
+        stamp = get_ftp_modify_time(ftp, directory)
+        name = get_cached_latest_dsc(key, stamp)
+        if name is None:
+            name = get_latest_dsc_name(list_ftp_directory(ftp, directory))
+    if stamp is not None and name is not None:
+        set_cached_latest_dsc(key, stamp, name)
+    return name
+
+def get_latest_dsc_url(host, directory):
+    """Return the url of the latest .dsc in `directory` of the archive at
+    `host`. The directory is read from its HTTP index page, or over FTP when
+    the index page cannot be read."""
+    directory_url = 'http://{}/{}/'.format(host, directory.strip('/'))
+    try:
+        name = get_latest_dsc_name_over_http(directory_url)
+    except (urllib.error.URLError, OSError):
+        name = None
+    if name is None:
+        name = get_latest_dsc_name_over_ftp(host, directory)
+    return urllib.parse.urljoin(directory_url, urllib.parse.quote(name))
+
+def get_debian_mirror_url():
+    """Return the url of the Debian mirror, `$AUR_TOOLS_DEBIAN_MIRROR` if
+    set. It may be a file:// url of a local mirror."""
+    mirror_url = os.environ.get('AUR_TOOLS_DEBIAN_MIRROR', DEBIAN_MIRROR_URL)
+    return mirror_url if mirror_url.endswith('/') else mirror_url + '/'
+
+def get_sources_index_url(suite='sid', component='main', mirror_url=None,
+        compression='.xz'):
+    return urllib.parse.urljoin(mirror_url or get_debian_mirror_url(),
+            'dists/{}/{}/source/Sources{}'.format(suite, component,
+                compression))
+
+def parse_sources_index(lines, mirror_url, package_names=None):
+    """Return a dictionary mapping the name of every source package in the
+    lines of a Sources index to the `SourcePackage` of its latest version.
+    Only the packages in `package_names` are kept if it is given."""
+    index = {}
+    package = version = directory = dsc_name = None
+    field = None
+    for line in itertools.chain(lines, ['\n']):
+        if line[:1] in (' ', '\t'):
+            if field in ('Files', 'Checksums-Sha256') and (
+                    line.rstrip().endswith('.dsc')):
+                dsc_name = line.split()[-1]
+            continue
+        if line.strip():
+            field, _, value = line.partition(':')
+            if field == 'Package':
+                package = value.strip()
+            elif field == 'Version':
+                version = value.strip()
+            elif field == 'Directory':
+                directory = value.strip()
+            continue
+
+        # A blank line ends the paragraph of a source package
+        if (package is not None and version is not None
+                and directory is not None and dsc_name is not None
+                and (package_names is None or package in package_names)):
+            previous = index.get(package)
+            if previous is None or (pkgbuild_lib.vercmp_key(version)
+                    > pkgbuild_lib.vercmp_key(previous.version)):
+                index[package] = SourcePackage(package, version,
+                        urllib.parse.urljoin(mirror_url, '{}/{}'.format(
+                            directory, urllib.parse.quote(dsc_name))))
+        package = version = directory = dsc_name = field = None
+    return index
+
+def get_sources_index(suite='sid', component='main', mirror_url=None,
+        compression='.xz'):
+    """Return the index of the source packages of `suite` built by
+    `parse_sources_index`. The compressed Sources index is downloaded
+    through the http cache and decompressed while it is parsed, once per
+    process."""
+    mirror_url = mirror_url or get_debian_mirror_url()
+    url = get_sources_index_url(suite, component, mirror_url, compression)
+    with _sources_indexes_lock:
+        if url not in _sources_indexes:
+            with urlopen(url) as compressed, SOURCES_INDEX_OPENERS[
+                    compression](compressed, 'rt', encoding='utf-8',
+                            errors='replace') as lines:
+                _sources_indexes[url] = parse_sources_index(lines,
+                        mirror_url)
+        return _sources_indexes[url]
+
+def get_dsc_urls_from_sources_index(package_names, suite='sid',
+        component='main', mirror_url=None):
+    """Return a dictionary mapping each of `package_names` found in the
+    Sources index of `suite` to the url of the .dsc of its latest
+    version."""
+    index = get_sources_index(suite, component, mirror_url)
+    return {package_name: index[package_name].dsc_url
+            for package_name in package_names if package_name in index}
+
+def get_upstream_dsc_url(upstream):
+    """Return the url of the latest .dsc of a package given its `upstream`
+    identifiers: `dsc_url`, `debian_package` for the Sources index of Debian
+    or `pool_directory` and `pool_host` for a pool directory."""
+    if 'dsc_url' in upstream:
+        return upstream['dsc_url']
+    if 'debian_package' in upstream:
+        return get_dsc_urls_from_sources_index(
+                [upstream['debian_package']])[upstream['debian_package']]
+    return get_latest_dsc_url(
+            upstream.get('pool_host', 'archive.ubuntu.com'),
+            upstream['pool_directory'])
+
+def fetch(job):
+    with metrics_lib.timed(job.timings, 'fetch'):
+        with urlopen(get_upstream_dsc_url(job.upstream)) as dsc:
+            job.data['dsc_url'] = dsc.url
+            job.data['dsc_content'] = dsc.read().decode('utf-8')
+    return job
+
+def parse(job):
+    with metrics_lib.timed(job.timings, 'parse'):
+        dsc_content = job.data['dsc_content']
+        version = get_version(dsc_content)
+        job.upstream_version = version.rsplit('-', 1)[0]
+        job.upstream_checksum = state_lib.get_content_hash(dsc_content)
+        return pipeline_lib.parse_unless_unchanged(job)
+
+def compare(job):
+    with metrics_lib.timed(job.timings, 'compare'):
+        pkgver = job.pkgbuild.get_value('pkgver')
+        if pkgbuild_lib.vercmp(pkgver, job.upstream_version) >= 0:
+            return pipeline_lib.set_up_to_date(job)
+    return job
+
+def rewrite(job):
+    with metrics_lib.timed(job.timings, 'rewrite'):
+        pkgbuild = job.pkgbuild
+        pkgbuild.set_value('pkgver', job.upstream_version)
+        pkgbuild.set_value('pkgrel', '1')
+
+        package_source_name = job.upstream['source_name_pattern'].format(
+                job.upstream_version)
+        checksums = get_checksums(job.data['dsc_content'],
+                package_source_name)
+        written_checksums = {}
+        for checksum_name, value in checksums.items():
+            try:
+                pkgbuild.set_array_values(
+                        '{}sums'.format(checksum_name.lower()), [value])
+            except ValueError:
+                continue
+            written_checksums[checksum_name] = value
+        # The files of a source package are next to its dsc. The name
+        # pattern of the manifest may only be the start of the file name.
+        # There is nothing to verify when no checksum was written.
+        if written_checksums:
+            source_file_name = get_source_file_name(job.data['dsc_content'],
+                    package_source_name)
+            job.sources = [verify_lib.make_source_file(urllib.parse.urljoin(
+                job.data['dsc_url'], urllib.parse.quote(source_file_name)),
+                written_checksums)]
+        return pipeline_lib.plan_update(job, {'PKGBUILD': pkgbuild.render()})
+
+def make_pipeline_source(src_parent, entries, dry_run=False):
+    """Return the `pipeline_lib.PipelineSource` of the dsc packages of the
+    manifest `entries`, whose PKGBUILDs are in `src_parent`."""
+    def discover():
+        return [pipeline_lib.PackageJob(source,
+            os.path.join(src_parent, entry.name), entry.upstream, dry_run)
+            for entry in entries]
+    source = pipeline_lib.PipelineSource('dsc', discover, fetch, parse,
+            compare, rewrite)
+    return source
+
+def update_package_with_dsc(pkgbuild_dir, dsc_url, package_source_name_pattern,
+        dry_run=False, verify=False):
+    """Update the PKGBUILD in `pkgbuild_dir` to the version of the dsc file
+    at `dsc_url` and commit it. Return the `pkgbuild_lib.PkgbuildUpdate` or
+    None if the package is already updated. When `dry_run` is true, nothing
+    is written nor committed. When `verify` is true, the source file is
+    downloaded and checked against its checksums first."""
+    source = make_pipeline_source(os.path.dirname(pkgbuild_dir), [])
+    return pipeline_lib.run_job(pipeline_lib.PackageJob(source, pkgbuild_dir,
+        {'dsc_url': dsc_url,
+            'source_name_pattern': package_source_name_pattern}, dry_run),
+        verify)
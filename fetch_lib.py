@@ -0,0 +1,204 @@
+import concurrent.futures
+import http.client
+import metrics_lib
+import random
+import threading
+import time
+import urllib.error
+
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# A host is not requested for CIRCUIT_OPEN_SECONDS after that many
+# consecutive failures
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_SECONDS = 60
+DEFAULT_HEDGE_AFTER = 5
+HEDGE_MAX_WORKERS = 64
+
+_timeout = DEFAULT_TIMEOUT
+_hedge_after = DEFAULT_HEDGE_AFTER
+_deadline = None
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+_hedge_executor = concurrent.futures.ThreadPoolExecutor(HEDGE_MAX_WORKERS,
+        thread_name_prefix='fetch')
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(urllib.error.URLError):
+    pass
+
+
+class CircuitBreaker(object):
+    """The health of a host. After `CIRCUIT_FAILURE_THRESHOLD` consecutive
+    failures the circuit opens and the host is not requested anymore. Once
+    `CIRCUIT_OPEN_SECONDS` elapsed a single request is let through, which
+    closes the circuit if it succeeds and opens it again otherwise."""
+    __slots__ = ('host', 'failures', 'opened_at', 'trying', '_lock')
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened_at = None
+        self.trying = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError if the host must not be requested now."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if (self.trying or
+                    time.monotonic() - self.opened_at < CIRCUIT_OPEN_SECONDS):
+                raise CircuitOpenError('Circuit of {} is open'.format(
+                    self.host))
+            self.trying = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trying = False
+
+    def record_cancel(self):
+        """Record a call which failed for another reason than the host."""
+        with self._lock:
+            self.trying = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trying = False
+            if (self.opened_at is not None
+                    or self.failures >= CIRCUIT_FAILURE_THRESHOLD):
+                if self.opened_at is None:
+                    metrics_lib.add('circuit_opens_total', host=self.host)
+                self.opened_at = time.monotonic()
+
+
+def configure(timeout=None, hedge_after=None, deadline=None):
+    """Set the timeout of the requests, the time after which a request
+    without response is hedged and the number of seconds from now after
+    which no request is made anymore, when given."""
+    global _timeout, _hedge_after, _deadline
+    if timeout is not None:
+        _timeout = float(timeout)
+    if hedge_after is not None:
+        _hedge_after = float(hedge_after)
+    if deadline is not None:
+        _deadline = time.monotonic() + float(deadline)
+
+def get_remaining():
+    """Return the number of seconds left before the deadline or None if
+    there is no deadline."""
+    if _deadline is None:
+        return None
+    return _deadline - time.monotonic()
+
+def check_deadline():
+    """Raise DeadlineExceeded if the deadline passed."""
+    remaining = get_remaining()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded('The deadline of the run passed')
+
+def get_timeout():
+    """Return the timeout of a request starting now, which never ends after
+    the deadline."""
+    check_deadline()
+    remaining = get_remaining()
+    if remaining is None:
+        return _timeout
+    return min(_timeout, remaining)
+
+def get_circuit_breaker(host):
+    with _circuit_breakers_lock:
+        breaker = _circuit_breakers.get(host)
+        if breaker is None:
+            breaker = _circuit_breakers[host] = CircuitBreaker(host)
+        return breaker
+
+def is_retryable(error):
+    """Return whether `error` may not happen again if the request is
+    retried, in which case it also counts as a failure of the host."""
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRYABLE_STATUSES
+    if isinstance(error, CircuitOpenError):
+        return False
+    return isinstance(error, (urllib.error.URLError, http.client.HTTPException,
+        OSError))
+
+def close_result(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def call_hedged(request):
+    """Return the result of `request`, which opens a response. If it has not
+    returned after the hedging delay, the same request is sent again and the
+    first response wins, the other is closed."""
+    first = _hedge_executor.submit(request)
+    done, _ = concurrent.futures.wait([first], _hedge_after)
+    if done:
+        return first.result()
+    metrics_lib.add('http_hedged_requests_total')
+    futures = [first, _hedge_executor.submit(request)]
+    pending = set(futures)
+    while pending:
+        done, pending = concurrent.futures.wait(pending,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+        winners = [future for future in done if future.exception() is None]
+        if winners:
+            for future in futures:
+                if future is not winners[0]:
+                    future.add_done_callback(close_result)
+            return winners[0].result()
+    # Both failed
+    return first.result()
+
+def sleep_before_retry(attempt, error):
+    """Wait before the retry following the failed `attempt`, with an
+    exponential backoff. Raise DeadlineExceeded instead if the deadline
+    would pass."""
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_SECONDS * 2 ** attempt)
+    delay *= random.uniform(0.5, 1)
+    remaining = get_remaining()
+    if remaining is not None and remaining <= delay:
+        raise DeadlineExceeded('The deadline of the run passed') from error
+    time.sleep(delay)
+
+def call(host, request, retries=DEFAULT_RETRIES):
+    """Return the result of `request`, which opens a response from `host`,
+    under the fetch policy: it is hedged when slow, retried at most
+    `retries` times with backoff after errors that may be transient, not
+    sent while the circuit of `host` is open nor after the deadline."""
+    breaker = get_circuit_breaker(host)
+    attempt = 0
+    while True:
+        check_deadline()
+        breaker.before_call()
+        try:
+            result = call_hedged(request)
+        except Exception as e:
+            if isinstance(e, urllib.error.HTTPError) and not is_retryable(e):
+                breaker.record_success()
+                raise
+            if not is_retryable(e):
+                breaker.record_cancel()
+                raise
+            breaker.record_failure()
+            if attempt == retries:
+                raise
+            if isinstance(e, urllib.error.HTTPError):
+                e.close()
+            sleep_before_retry(attempt, e)
+            metrics_lib.add('http_retries_total', host=host)
+            attempt += 1
+            continue
+        breaker.record_success()
+        return result
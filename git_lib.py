@@ -0,0 +1,33 @@
+import metrics_lib
+import subprocess
+
+
+def run_git(repo_path, *args):
+    """Run git with `args` on the repository at `repo_path` and return its
+    standard output. The repository is given to git with `-C`, so the
+    current directory of the process is never changed and several
+    repositories can be worked on concurrently."""
+    with metrics_lib.timer('subprocess_seconds', command='git',
+            subcommand=args[0]):
+        res = subprocess.run(['git', '-C', repo_path] + list(args),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, check=True)
+    return res.stdout
+
+def commit(repo_path, message, paths):
+    """Commit the current content of `paths`, relative to `repo_path`."""
+    run_git(repo_path, 'commit', '-m', message, '--', *paths)
+
+def get_ahead_count(repo_path, remote_ref):
+    """Return the number of commits of HEAD that are not in `remote_ref` or
+    None if `repo_path` is not a git repository having `remote_ref`. Only
+    one git process is spawned when HEAD and `remote_ref` are the same."""
+    try:
+        head, remote = run_git(repo_path, 'rev-parse', 'HEAD',
+                remote_ref).split()
+        if head == remote:
+            return 0
+        return int(run_git(repo_path, 'rev-list', '--count',
+            '{}..HEAD'.format(remote_ref)))
+    except subprocess.CalledProcessError:
+        return None
@@ -0,0 +1,440 @@
+import cache_lib
+import fetch_lib
+import functools
+import hashlib
+import http.client
+import json
+import metrics_lib
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+
+HTTP_CACHE_MAX_BYTES = 512 * 1024 * 1024
+HTTP_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+COPY_CHUNK_SIZE = 64 * 1024
+HTTP_POOL_MAX_IDLE_PER_HOST = 8
+HTTP_MAX_REDIRECTS = 10
+HTTP_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+HTTP_USER_AGENT = 'aur-tools'
+ACCEPT_ENCODING = 'gzip, deflate'
+# Maps the content codings that are decoded to the wbits of their zlib
+# decompressor
+CONTENT_ENCODING_WBITS = {
+        'gzip': 16 + zlib.MAX_WBITS,
+        'x-gzip': 16 + zlib.MAX_WBITS,
+        'deflate': zlib.MAX_WBITS,
+}
+
+_eviction_lock = threading.Lock()
+_ssl_context = None
+_ssl_context_lock = threading.Lock()
+
+
+def get_ssl_context():
+    """Return the ssl context shared by the https connections, since loading
+    the certificates for each connection is slow."""
+    global _ssl_context
+    with _ssl_context_lock:
+        if _ssl_context is None:
+            _ssl_context = ssl.create_default_context()
+        return _ssl_context
+
+
+class ConnectionPool(object):
+    """Keep-alive connections kept open between requests, at most
+    `max_idle` for each scheme, host and port."""
+    def __init__(self, max_idle=HTTP_POOL_MAX_IDLE_PER_HOST):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get_connection(self, key):
+        """Return an idle connection to the `(scheme, host, port)` of `key`
+        or a new one, and whether it is reused."""
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(host, port,
+                    context=get_ssl_context())
+        else:
+            connection = http.client.HTTPConnection(host, port)
+        metrics_lib.add('http_connections_total', scheme=scheme)
+        return connection, False
+
+    def release_connection(self, key, connection):
+        """Keep `connection`, whose last response was read entirely, for the
+        next request to `key`."""
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+connection_pool = ConnectionPool()
+
+
+class PooledResponse(object):
+    """A response read from a connection of a `ConnectionPool`. The
+    connection goes back to the pool once the body is read entirely, or when
+    the response is closed if what is left of the body is short enough to
+    be skipped."""
+    def __init__(self, url, pool, key, connection, response):
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def geturl(self):
+        return self.url
+
+    def read(self, *args):
+        fetch_lib.check_deadline()
+        data = self._response.read(*args)
+        if self._response.isclosed():
+            # The body was read entirely
+            self.close()
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        response = self._response
+        try:
+            if (not response.isclosed() and response.length is not None
+                    and response.length <= COPY_CHUNK_SIZE):
+                response.read()
+        except (http.client.HTTPException, OSError):
+            pass
+        if response.isclosed() and not response.will_close:
+            self._pool.release_connection(self._key, connection)
+        else:
+            response.close()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DecodedBody(object):
+    """A file object over the body of a response with the content coding
+    `encoding`, decompressed as it is read so that the whole body never
+    has to be held in memory."""
+    def __init__(self, body_file, encoding):
+        self._body_file = body_file
+        self._decompressor = zlib.decompressobj(
+                CONTENT_ENCODING_WBITS[encoding])
+
+    def read(self, size=-1):
+        chunks = []
+        length = 0
+        while size is None or size < 0 or length < size:
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                if self._decompressor.eof:
+                    break
+                data = self._body_file.read(COPY_CHUNK_SIZE)
+                if not data:
+                    chunks.append(self._decompressor.flush())
+                    break
+                metrics_lib.add('http_compressed_bytes_total', len(data))
+            max_length = 0 if size is None or size < 0 else size - length
+            chunk = self._decompressor.decompress(data, max_length)
+            chunks.append(chunk)
+            length += len(chunk)
+        return b''.join(chunks)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._body_file.close()
+
+
+def get_decoded_body(response):
+    """Return a file object over the decompressed body of `response`."""
+    encoding = response.headers.get('Content-Encoding', '').strip().lower()
+    if encoding in CONTENT_ENCODING_WBITS:
+        return DecodedBody(response, encoding)
+    return response
+
+
+class Response(object):
+    """A file object over the body of a response. `url` is the url of the
+    response after redirection, `from_cache` tells whether the body is served
+    from the cache because upstream did not change. The bytes read are
+    counted as received when `metered` is true, i.e. when `body_file` is the
+    body of the live response."""
+    def __init__(self, url, body_file, validators, from_cache, metered=False):
+        self.url = url
+        self.validators = validators
+        self.from_cache = from_cache
+        self._body_file = body_file
+        self._metered = metered
+        self._closed = False
+
+    def read(self, *args):
+        data = self._body_file.read(*args)
+        if self._metered:
+            metrics_lib.add('http_received_bytes_total', len(data))
+        return data
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._closed = True
+        self._body_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_cache_entry_paths(url):
+    """Return the paths of the body and of the metadata cached for `url`."""
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    cache_dir = cache_lib.get_cache_dir('http')
+    return (os.path.join(cache_dir, '{}.body'.format(key)),
+            os.path.join(cache_dir, '{}.json'.format(key)))
+
+def load_cache_entry(url):
+    """Return the metadata cached for `url` or None if it is not cached."""
+    body_path, meta_path = get_cache_entry_paths(url)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if not os.path.exists(body_path):
+        return None
+    return meta
+
+def store_cache_entry(url, response, validators):
+    """Copy the body of `response` in the cache of `url`, decompressing it
+    while it is written, and return the path of the cached body."""
+    body_path, meta_path = get_cache_entry_paths(url)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(body_path),
+            prefix='.{}.'.format(os.path.basename(body_path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(get_decoded_body(response), f,
+                    COPY_CHUNK_SIZE)
+            metrics_lib.add('http_received_bytes_total', f.tell())
+        os.replace(tmp_path, body_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    meta = dict(validators, url=url, response_url=response.geturl())
+    cache_lib.write_atomically(meta_path, json.dumps(meta))
+    return body_path
+
+def evict_cache_entries(max_bytes=HTTP_CACHE_MAX_BYTES,
+        max_age=HTTP_CACHE_MAX_AGE):
+    """Remove the cached responses that were not used for `max_age` seconds,
+    then the least recently used ones until the cache holds at most
+    `max_bytes` bytes."""
+    cache_dir = cache_lib.get_cache_dir('http')
+    now = time.time()
+    with _eviction_lock:
+        entries = []
+        for name in os.listdir(cache_dir):
+            if not name.endswith('.body'):
+                continue
+            body_path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(body_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, body_path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for mtime, size, body_path in sorted(entries):
+            if now - mtime <= max_age and total_size <= max_bytes:
+                break
+            meta_path = '{}.json'.format(body_path[:-len('.body')])
+            for path in (meta_path, body_path):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+
+def get_connection_key(url):
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    return parts.scheme, parts.hostname, port
+
+def send_request(pool, key, path, headers, timeout, method='GET'):
+    """Send a `method` request for `path` on a connection of `pool` to `key`
+    and return the connection and its response. A reused connection that the
+    server closed while it was idle is replaced by another."""
+    while True:
+        connection, reused = pool.get_connection(key)
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        try:
+            connection.request(method, path, headers=headers)
+            return connection, connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError,
+                BrokenPipeError):
+            connection.close()
+            if not reused:
+                raise
+        except BaseException:
+            connection.close()
+            raise
+
+def open_once(url, headers, pool, method='GET'):
+    """Send a single `method` request for the http or https `url` and return
+    its response, which may be a redirection. Raise urllib.error.HTTPError
+    for other statuses than 2xx and 3xx."""
+    parts = urllib.parse.urlsplit(url)
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if proxy and not urllib.request.proxy_bypass(parts.hostname):
+        return urllib.request.urlopen(urllib.request.Request(url,
+            headers=headers, method=method), timeout=fetch_lib.get_timeout())
+    path = parts.path or '/'
+    if parts.query:
+        path = '{}?{}'.format(path, parts.query)
+    key = get_connection_key(url)
+    try:
+        connection, response = send_request(pool, key, path, headers,
+                fetch_lib.get_timeout(), method)
+    except (http.client.HTTPException, OSError) as e:
+        raise urllib.error.URLError(e)
+    response = PooledResponse(url, pool, key, connection, response)
+    if not 200 <= response.status < 400:
+        raise urllib.error.HTTPError(url, response.status, response.reason,
+                response.headers, response)
+    return response
+
+def open_url(url, headers=None, pool=None, method='GET'):
+    """Open `url` like `urllib.request.urlopen` but on a keep-alive
+    connection of `pool`, `connection_pool` by default, following
+    redirections. `method` may be 'HEAD' to only get the headers. Each
+    request goes through `fetch_lib.call`, so it times out, is retried and
+    hedged, and fails once the deadline passed. Raise
+    urllib.error.HTTPError for other statuses than 2xx. Urls of other
+    schemes than http and https are opened by urllib with a timeout only,
+    as are the urls that go through a proxy."""
+    pool = connection_pool if pool is None else pool
+    headers = dict({'User-Agent': HTTP_USER_AGENT}, **(headers or {}))
+    for _ in range(HTTP_MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            return urllib.request.urlopen(urllib.request.Request(url,
+                headers=headers, method=method),
+                timeout=fetch_lib.get_timeout())
+        response = fetch_lib.call(parts.hostname, functools.partial(
+            open_once, url, headers, pool, method))
+        location = response.headers.get('Location')
+        if response.status in HTTP_REDIRECT_STATUSES and location:
+            response.close()
+            url = urllib.parse.urljoin(url, location)
+            continue
+        if not 200 <= response.status < 300:
+            raise urllib.error.HTTPError(url, response.status,
+                    response.reason, response.headers, response)
+        return response
+    raise urllib.error.HTTPError(url, response.status,
+            'Too many redirections', response.headers, None)
+
+def urlopen(url, headers=None):
+    """Open `url` like `urllib.request.urlopen` through the on-disk http
+    cache. Responses carrying an ETag or a Last-Modified header are stored
+    with them, and later requests for the same url are made conditional so
+    that an unchanged upstream is served from the cache. Bodies are requested
+    compressed. A body that is cached is decompressed while it is written to
+    the cache, and the caller reads it from the disk once it is entirely
+    received; only the bodies without validators are decompressed as the
+    caller reads them from the connection. Urls of other schemes than http
+    and https, like file:// mirrors, are not cached."""
+    headers = dict({'Accept-Encoding': ACCEPT_ENCODING}, **(headers or {}))
+    if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+        response = open_url(url, headers)
+        return Response(response.geturl(), response, {}, False)
+
+    body_path = get_cache_entry_paths(url)[0]
+    meta = load_cache_entry(url)
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        with metrics_lib.timer('http_request_seconds'):
+            response = open_url(url, headers)
+    except urllib.error.HTTPError as e:
+        metrics_lib.add('http_requests_total', status=e.code)
+        if e.code != 304 or meta is None:
+            raise
+        e.close()
+        metrics_lib.add('cache_hits_total', cache='http')
+        # Mark the entry as recently used
+        os.utime(body_path)
+        validators = {key: meta.get(key) for key in ('etag', 'last_modified')}
+        return Response(meta['response_url'], open(body_path, 'rb'),
+                validators, True)
+
+    metrics_lib.add('http_requests_total', status=response.status)
+    metrics_lib.add('cache_misses_total', cache='http')
+    validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+    }
+    if not any(validators.values()):
+        return Response(response.geturl(), get_decoded_body(response),
+                validators, False, metered=True)
+
+    with response:
+        body_path = store_cache_entry(url, response, validators)
+    body_file = open(body_path, 'rb')
+    evict_cache_entries()
+    return Response(response.geturl(), body_file, validators, False)
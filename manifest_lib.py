@@ -0,0 +1,77 @@
+import cache_lib
+import collections
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.dirname(__file__),
+        'packages.json')
+LAST_CHECKS_CACHE_NAME = 'package-last-checks.json'
+UPDATERS = ('dsc', 'pypi')
+DEFAULT_INTERVAL_HOURS = 24
+
+_last_checks_lock = threading.Lock()
+
+ManifestEntry = collections.namedtuple('ManifestEntry',
+        ['name', 'updater', 'upstream', 'interval', 'priority'])
+ManifestEntry.__doc__ = """A package declared in the manifest. `name` is the
+directory of its PKGBUILD, `updater` the kind of upstream it follows,
+`upstream` the identifiers of the package upstream, `interval` the number of
+seconds between two checks and `priority` orders the packages that are due,
+highest first."""
+
+
+def make_manifest_entry(package):
+    """Return the `ManifestEntry` of a package of the manifest. Raise
+    ValueError if the package is not valid."""
+    try:
+        name, updater = package['name'], package['updater']
+    except KeyError as e:
+        raise ValueError('Package {} has no {}'.format(package, e))
+    if updater not in UPDATERS:
+        raise ValueError('Unknown updater {} of {}'.format(updater, name))
+    upstream = package.get('upstream', {})
+    if updater == 'dsc' and not ('debian_package' in upstream
+            or 'pool_directory' in upstream):
+        raise ValueError(
+                'dsc package {} has no debian_package nor pool_directory'
+                .format(name))
+    if updater == 'dsc' and 'source_name_pattern' not in upstream:
+        raise ValueError('dsc package {} has no source_name_pattern'.format(
+            name))
+    interval = float(package.get('interval_hours',
+        DEFAULT_INTERVAL_HOURS)) * 60 * 60
+    return ManifestEntry(name, updater, upstream, interval,
+            int(package.get('priority', 0)))
+
+def load_manifest(path=DEFAULT_MANIFEST_PATH):
+    """Return the `ManifestEntry` of every package of the manifest at
+    `path`."""
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    return [make_manifest_entry(package) for package in manifest['packages']]
+
+def get_last_checks():
+    """Return a dictionary mapping the name of the packages to the time they
+    were last checked."""
+    with _last_checks_lock:
+        return cache_lib.load_json(LAST_CHECKS_CACHE_NAME, {})
+
+def set_last_check(name, check_time):
+    with _last_checks_lock:
+        last_checks = cache_lib.load_json(LAST_CHECKS_CACHE_NAME, {})
+        last_checks[name] = check_time
+        cache_lib.save_json(LAST_CHECKS_CACHE_NAME, last_checks)
+
+def get_due_entries(entries, now=None, last_checks=None):
+    """Return the entries whose interval elapsed since their last check, by
+    decreasing priority and, for the same priority, the longest unchecked
+    first."""
+    now = time.time() if now is None else now
+    last_checks = get_last_checks() if last_checks is None else last_checks
+    due_entries = [entry for entry in entries
+            if now - last_checks.get(entry.name, 0) >= entry.interval]
+    return sorted(due_entries, key=lambda entry: (-entry.priority,
+        last_checks.get(entry.name, 0)))
@@ -0,0 +1,168 @@
+import cache_lib
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+# Metrics are kept per process in these maps, keyed by `(name, labels)`
+# where `labels` is a sorted tuple of (label, value) pairs
+_counters = {}
+_durations = {}
+_lock = threading.Lock()
+
+METRIC_PREFIX = 'aur_tools_'
+METRIC_HELP = {
+        'cache_hits_total': 'Lookups answered by a cache.',
+        'circuit_opens_total': 'Times a host was given up after failures.',
+        'cache_misses_total': 'Lookups not answered by a cache.',
+        'http_compressed_bytes_total':
+            'Bytes of compressed HTTP response bodies received.',
+        'http_connections_total': 'HTTP connections opened.',
+        'http_hedged_requests_total':
+            'HTTP requests sent again because they were slow.',
+        'http_requests_total': 'HTTP requests, by response status.',
+        'http_received_bytes_total':
+            'Bytes of HTTP response bodies received, once decompressed.',
+        'http_request_seconds': 'Time to get the response headers.',
+        'http_retries_total': 'HTTP requests retried after an error.',
+        'package_seconds': 'Time spent updating a package.',
+        'packages_total': 'Packages checked, by source and outcome.',
+        'phase_seconds': 'Time spent in a phase of an update.',
+        'source_resumed_bytes_total': 'Bytes of sources not downloaded again.',
+        'subprocess_seconds': 'Time spent waiting for subprocesses.',
+        'task_seconds': 'Time spent running a task.',
+}
+
+
+def get_key(name, labels):
+    return name, tuple(sorted((key, str(value))
+        for key, value in labels.items()))
+
+def add(name, value=1, **labels):
+    """Add `value` to the counter `name` with `labels`."""
+    key = get_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    """Record a duration of `seconds` for `name` with `labels`."""
+    key = get_key(name, labels)
+    with _lock:
+        count, total = _durations.get(key, (0, 0))
+        _durations[key] = (count + 1, total + seconds)
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Record the time spent in the block as a duration of `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+@contextlib.contextmanager
+def timed(timings, phase):
+    """Add the time spent in the block to `timings[phase]` and record it in
+    the `phase_seconds` metric."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        timings[phase] = timings.get(phase, 0) + duration
+        observe('phase_seconds', duration, phase=phase)
+
+def snapshot():
+    """Return a copy of the counters and of the durations recorded so far."""
+    with _lock:
+        return dict(_counters), dict(_durations)
+
+def get_difference(start, end):
+    """Return the counters and durations recorded between the snapshots
+    `start` and `end`."""
+    counters = {key: value - start[0].get(key, 0)
+            for key, value in end[0].items()}
+    durations = {}
+    for key, (count, total) in end[1].items():
+        start_count, start_total = start[1].get(key, (0, 0))
+        durations[key] = (count - start_count, total - start_total)
+    return ({key: value for key, value in counters.items() if value},
+            {key: value for key, value in durations.items() if value[0]})
+
+def to_json(counters, durations):
+    def to_entry(key, **fields):
+        return dict(fields, name=key[0], labels=dict(key[1]))
+    return {
+        'counters': [to_entry(key, value=value)
+            for key, value in sorted(counters.items())],
+        'durations': [to_entry(key, count=count, seconds=total)
+            for key, (count, total) in sorted(durations.items())],
+    }
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(key,
+        value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels))
+
+def to_prometheus(counters, durations, task):
+    """Return the metrics in the Prometheus text exposition format. Every
+    sample is labelled with `report="<task>"`, so that the reports of nested
+    tasks do not export the same series; durations are exposed as summaries
+    without quantiles."""
+    samples = {}
+    for (name, labels), value in counters.items():
+        samples.setdefault((name, 'counter'), []).append(
+                (name, labels, value))
+    for (name, labels), (count, total) in durations.items():
+        samples.setdefault((name, 'summary'), []).extend([
+            ('{}_count'.format(name), labels, count),
+            ('{}_sum'.format(name), labels, total)])
+
+    lines = []
+    for (name, metric_type), metric_samples in sorted(samples.items()):
+        lines.append('# HELP {}{} {}'.format(METRIC_PREFIX, name,
+            METRIC_HELP.get(name, name)))
+        lines.append('# TYPE {}{} {}'.format(METRIC_PREFIX, name,
+            metric_type))
+        for sample_name, labels, value in sorted(metric_samples):
+            lines.append('{}{}{} {}'.format(METRIC_PREFIX, sample_name,
+                format_labels((('report', task),) + labels), value))
+    return ''.join('{}\n'.format(line) for line in lines)
+
+def get_report_dir():
+    """Return the directory of the reports, `$AUR_TOOLS_METRICS_DIR` if set
+    so that it can point to the directory of the textfile collector of
+    node_exporter."""
+    report_dir = os.environ.get('AUR_TOOLS_METRICS_DIR')
+    if report_dir is None:
+        return cache_lib.get_cache_dir('metrics')
+    os.makedirs(report_dir, exist_ok=True)
+    return report_dir
+
+def write_report(task, counters, durations):
+    """Write the metrics of `task` as `<task>.json` and `<task>.prom` in the
+    report directory and return the path of the json report."""
+    report_dir = get_report_dir()
+    json_path = os.path.join(report_dir, '{}.json'.format(task))
+    report = dict(to_json(counters, durations), task=task, time=time.time())
+    cache_lib.write_atomically(json_path,
+            json.dumps(report, indent=2, sort_keys=True))
+    cache_lib.write_atomically(os.path.join(report_dir,
+        '{}.prom'.format(task)), to_prometheus(counters, durations, task))
+    return json_path
+
+@contextlib.contextmanager
+def report(task):
+    """Time the block as `task` and write the report of the metrics recorded
+    during the block when it ends, even if it fails. The report of a task
+    includes the metrics of the tasks nested in it."""
+    start = snapshot()
+    try:
+        with timer('task_seconds', task=task):
+            yield
+    finally:
+        write_report(task, *get_difference(start, snapshot()))
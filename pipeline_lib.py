@@ -0,0 +1,271 @@
+import collections
+import fetch_lib
+import metrics_lib
+import os
+import pkgbuild_lib
+import queue
+import state_lib
+import threading
+import time
+import verify_lib
+
+
+STAGES = ('fetch', 'parse', 'compare', 'rewrite', 'verify', 'commit')
+DEFAULT_STAGE_WORKERS = {
+        'fetch': 8,
+        'parse': 2,
+        'compare': 2,
+        'rewrite': 2,
+        'verify': 4,
+        'commit': 4,
+}
+DEFAULT_QUEUE_SIZE = 16
+
+PipelineSource = collections.namedtuple('PipelineSource',
+        ['name', 'discover', 'fetch', 'parse', 'compare', 'rewrite'])
+PipelineSource.__doc__ = """A family of packages updated by the pipeline.
+`discover` returns the `PackageJob` of every package to check. The other
+functions are the stages of a job: each takes the job and returns it to pass
+it to the next stage, or None when there is nothing more to do for the
+package. The verify and commit stages are the same for every source."""
+
+PipelineResult = collections.namedtuple('PipelineResult',
+        ['source', 'name', 'job', 'status', 'update', 'error'])
+PipelineResult.__doc__ = """The outcome of a package: its `status`, its
+planned or written `update` if it needed one and the exception which stopped
+it if any. For a source whose discovery failed, `name` and `job` are None."""
+
+
+class PackageJob(object):
+    """The state of a package going through the pipeline. `upstream` holds
+    what the source knows of the package before fetching and `data` what the
+    stages of the source pass to each other. A stage that ends the job early
+    tells why in `status`. The rewrite stage lists in `sources` the
+    `verify_lib.SourceFile` of the upstream files of the update."""
+    __slots__ = ('source', 'src_path', 'upstream', 'dry_run', 'timings',
+            'start', 'data', 'pkgbuild', 'pkgname', 'upstream_version',
+            'upstream_checksum', 'update', 'sources', 'status')
+
+    def __init__(self, source, src_path, upstream=None, dry_run=False):
+        self.source = source
+        self.src_path = src_path
+        self.upstream = upstream
+        self.dry_run = dry_run
+        self.timings = collections.OrderedDict()
+        self.start = time.perf_counter()
+        self.data = {}
+        self.pkgbuild = None
+        self.pkgname = None
+        self.upstream_version = None
+        self.upstream_checksum = None
+        self.update = None
+        self.sources = []
+        self.status = None
+
+    @property
+    def name(self):
+        return state_lib.get_package_key(self.src_path)
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(type(self).__name__, self.source.name,
+                self.src_path)
+
+
+def read_pkgbuild(job):
+    """Parse the PKGBUILD of `job`, unless it already is."""
+    if job.pkgbuild is None:
+        with open(os.path.join(job.src_path, 'PKGBUILD'), 'r') as pkgbuild:
+            job.pkgbuild = pkgbuild_lib.PkgbuildDocument(pkgbuild.read())
+        job.pkgname = job.pkgbuild.get_value('pkgname')
+    return job.pkgbuild
+
+def parse_unless_unchanged(job):
+    """Return None if neither upstream nor the PKGBUILD of `job` changed
+    since it was last up to date, parse the PKGBUILD and return `job`
+    otherwise. `job.upstream_version` and `job.upstream_checksum` must be
+    set."""
+    if state_lib.is_package_unchanged(job.src_path, job.upstream_version,
+            job.upstream_checksum):
+        print('{} unchanged since last run'.format(job.name))
+        job.status = 'unchanged'
+        return None
+    read_pkgbuild(job)
+    return job
+
+def set_up_to_date(job):
+    """Record that `job` is up to date, unless it is a dry run, and return
+    None."""
+    print('{} already updated'.format(job.pkgname))
+    job.status = 'up to date'
+    if not job.dry_run:
+        state_lib.set_package_state(job.src_path, job.upstream_version,
+                job.upstream_checksum, job.pkgbuild.content)
+    return None
+
+def verify(job):
+    """Check the upstream files of the update planned for `job` against
+    their checksums before it is committed."""
+    with metrics_lib.timed(job.timings, 'verify'):
+        verify_lib.verify_sources(job.sources)
+    return job
+
+def commit(job):
+    """Write and commit the update planned for `job` and record the state of
+    the package, unless `job` is a dry run."""
+    if not job.dry_run:
+        pkgbuild_lib.write_update(job.src_path, job.update)
+        state_lib.set_package_state(job.src_path, job.upstream_version,
+                job.upstream_checksum, job.update.files['PKGBUILD'])
+    return job
+
+def plan_update(job, files):
+    """Set the `pkgbuild_lib.PkgbuildUpdate` of `job` writing `files`."""
+    job.update = pkgbuild_lib.PkgbuildUpdate(job.pkgname,
+            job.upstream_version, job.pkgbuild.changes, files, job.timings)
+    return job
+
+def get_stages(verify=False):
+    """Return the stages a job goes through, with the verify stage only if
+    `verify` is true."""
+    if verify:
+        return STAGES
+    return tuple(stage for stage in STAGES if stage != 'verify')
+
+def get_stage_function(job, stage):
+    if stage == 'verify':
+        return verify
+    if stage == 'commit':
+        return commit
+    return getattr(job.source, stage)
+
+def run_job(job, verify=False):
+    """Run every stage of `job` one after another, verifying the upstream
+    files of the update if `verify` is true. Return the
+    `pkgbuild_lib.PkgbuildUpdate` of the package or None."""
+    for stage in get_stages(verify):
+        job = get_stage_function(job, stage)(job)
+        if job is None:
+            return None
+    return job.update
+
+def run_pipeline(sources, stage_workers=None, queue_size=DEFAULT_QUEUE_SIZE,
+        on_result=None, verify=False):
+    """Update the packages of every source of `sources` and return their
+    `PipelineResult`.
+
+    The sources discover their packages at the same time. Each stage is run
+    by its own threads, as many as given in `stage_workers` for the stage,
+    and consecutive stages are connected by queues of at most `queue_size`
+    jobs, so that a package is fetched while another is being rewritten or
+    committed. A failing package does not stop the others, and once the
+    deadline of `fetch_lib` passed the packages left end with the status
+    'timed out' as soon as they need to fetch something. `on_result` is
+    called with each result as soon as it is known. When `verify` is true,
+    the upstream files of the updates are downloaded and checked against
+    their checksums before the updates are committed."""
+    if not sources:
+        return []
+    stages = get_stages(verify)
+    workers = dict(DEFAULT_STAGE_WORKERS, **(stage_workers or {}))
+    queues = [queue.Queue(queue_size) for _ in stages]
+    # Number of producers still running for each queue: the discovery
+    # threads for the first stage, the workers of the previous stage for
+    # the others
+    producers = [len(sources)] + [workers[stage] for stage in stages[:-1]]
+    producers_lock = threading.Lock()
+    results = []
+    results_lock = threading.Lock()
+
+    def add_result(source, job, update=None, error=None):
+        if isinstance(error, fetch_lib.DeadlineExceeded):
+            status = 'timed out'
+        elif error is not None:
+            status = 'failed'
+        elif update is not None:
+            status = 'planned' if job.dry_run else 'updated'
+        else:
+            status = job.status or 'skipped'
+        result = PipelineResult(source.name, job and job.name, job, status,
+                update, error)
+        with results_lock:
+            results.append(result)
+        # A worker that stopped on a failure of the reporting would leave
+        # the producers of its stage blocked on the full queue
+        try:
+            if job is not None:
+                metrics_lib.observe('package_seconds',
+                        time.perf_counter() - job.start, package=job.name)
+            metrics_lib.add('packages_total', source=source.name,
+                    status=status)
+            if on_result is not None:
+                on_result(result)
+        except Exception as e:
+            print('{}: failed to report the result: {!r}'.format(
+                result.name or result.source, e))
+
+    def finish_producing(index):
+        with producers_lock:
+            producers[index] -= 1
+            is_last = producers[index] == 0
+        if is_last:
+            for _ in range(workers[stages[index]]):
+                queues[index].put(None)
+
+    def discover(source):
+        try:
+            for job in source.discover():
+                queues[0].put(job)
+        except Exception as e:
+            add_result(source, None, error=e)
+        finally:
+            finish_producing(0)
+
+    def work(index):
+        stage = stages[index]
+        try:
+            while True:
+                job = queues[index].get()
+                if job is None:
+                    break
+                try:
+                    next_job = get_stage_function(job, stage)(job)
+                except Exception as e:
+                    add_result(job.source, job, error=e)
+                    continue
+                if next_job is None:
+                    add_result(job.source, job)
+                elif index + 1 == len(stages):
+                    add_result(job.source, job, update=job.update)
+                else:
+                    queues[index + 1].put(next_job)
+        finally:
+            if index + 1 < len(stages):
+                finish_producing(index + 1)
+
+    threads = [threading.Thread(target=discover, args=(source,),
+        name='discover-{}'.format(source.name)) for source in sources]
+    for index, stage in enumerate(stages):
+        threads.extend(threading.Thread(target=work, args=(index,),
+            name='{}-{}'.format(stage, i)) for i in range(workers[stage]))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def format_summary(results):
+    """Return a human readable summary of the `PipelineResult` of a run:
+    the number of packages of each status by source, then every failure."""
+    statuses = collections.OrderedDict()
+    for result in results:
+        source_statuses = statuses.setdefault(result.source,
+                collections.Counter())
+        source_statuses[result.status] += 1
+    lines = ['{}: {}'.format(source, ', '.join('{} {}'.format(count, status)
+        for status, count in sorted(source_statuses.items())))
+        for source, source_statuses in statuses.items()]
+    for result in results:
+        if result.error is not None:
+            lines.append('  {} {}: {!r}'.format(result.source,
+                result.name or 'discovery', result.error))
+    return '\n'.join(lines)
@@ -1,12 +1,107 @@
+import collections
+import functools
+import git_lib
 import os
 import re
 import shlex
-import subprocess
 
 
-def vercmp(run, ver1, ver2):
-    vercmp_res = run('vercmp {} {}'.format(ver1, ver2))
-    return int(vercmp_res)
+VERSION_SEGMENT_PATTERN = re.compile(r'([^a-zA-Z0-9]*)([0-9]+|[a-zA-Z]+)')
+
+
+def split_version_segments(version):
+    """Split `version` the way libalpm's rpmvercmp walks it. Return a tuple
+    of the list of (separator length, is numeric, segment) tuples and the
+    number of separator characters trailing the last segment."""
+    segments = []
+    pos = 0
+    for match in VERSION_SEGMENT_PATTERN.finditer(version):
+        separator, segment = match.groups()
+        segments.append((len(separator), segment.isdigit(), segment))
+        pos = match.end()
+    return segments, len(version) - pos
+
+def rpmvercmp(ver1, ver2):
+    """Compare two version strings the same way as libalpm's rpmvercmp.
+    Return -1, 0 or 1 when `ver1` is respectively older, equal or newer than
+    `ver2`."""
+    if ver1 == ver2:
+        return 0
+    segments1, trailing1 = split_version_segments(ver1)
+    segments2, trailing2 = split_version_segments(ver2)
+    for (sep1, isnum1, seg1), (sep2, isnum2, seg2) in zip(segments1, segments2):
+        if sep1 != sep2:
+            return -1 if sep1 < sep2 else 1
+        if isnum1 != isnum2:
+            # Numeric segments are always newer than alpha segments
+            return 1 if isnum1 else -1
+        if isnum1:
+            seg1, seg2 = int(seg1), int(seg2)
+        if seg1 != seg2:
+            return -1 if seg1 < seg2 else 1
+
+    common = min(len(segments1), len(segments2))
+    if len(segments1) == len(segments2):
+        if bool(trailing1) == bool(trailing2):
+            return 0
+        return 1 if trailing1 else -1
+    # The final showdown: a remaining alpha segment never beats an empty
+    # string, whereas a remaining numeric segment always does.
+    if len(segments1) > common:
+        sep, isnum, _ = segments1[common]
+        return -1 if not isnum and (trailing2 or sep == 0) else 1
+    sep, isnum, _ = segments2[common]
+    return 1 if not isnum and (trailing1 or sep == 0) else -1
+
+def parse_evr(version):
+    """Split a full pacman version into its epoch, version and release.
+    The release is None when `version` does not have one."""
+    match = re.match(r'([0-9]*):', version)
+    if match:
+        epoch = match.group(1) or '0'
+        version = version[match.end():]
+    else:
+        epoch = '0'
+    version, sep, release = version.rpartition('-')
+    if not sep:
+        version, release = release, None
+    return epoch, version, release
+
+def vercmp(ver1, ver2):
+    """Compare two full pacman versions ([epoch:]version[-release]) exactly
+    like pacman's `vercmp` utility, without spawning it."""
+    if ver1 == ver2:
+        return 0
+    epoch1, version1, release1 = parse_evr(ver1)
+    epoch2, version2, release2 = parse_evr(ver2)
+    res = rpmvercmp(epoch1, epoch2)
+    if res == 0:
+        res = rpmvercmp(version1, version2)
+        if res == 0 and release1 is not None and release2 is not None:
+            res = rpmvercmp(release1, release2)
+    return res
+
+def _version_key(version):
+    segments, trailing = split_version_segments(version)
+    key = [(sep, 1 if isnum else 0, int(seg) if isnum else seg)
+            for sep, isnum, seg in segments]
+    # The end of the version sorts after an alpha segment that is not
+    # separated from it and before a numeric segment, and trailing
+    # separators make it sort after a version without them.
+    key.append((1, 0.5) if trailing else (0, 0.5))
+    return tuple(key)
+
+@functools.lru_cache(maxsize=4096)
+def vercmp_key(version):
+    """Return a sort key for the full pacman version `version`, so that
+    sorting with it orders versions like `vercmp` without comparing pairs.
+    Versions without a release sort before the same version with one. The
+    key only differs from `vercmp` for versions that mix trailing separators
+    with separator runs of other lengths, for which `vercmp` itself is not
+    transitive."""
+    epoch, version, release = parse_evr(version)
+    return (int(epoch), _version_key(version),
+            () if release is None else _version_key(release))
 
 
 def extract_array_var_pattern(bash_script, varname):
@@ -51,16 +146,193 @@ def replace_pkgbuild_var_value(pkgbuild_content, var_name, var_value):
     return pkgbuild_content.replace(orig_var_and_var_value,
             patt.format(var_value))
 
-def commit_pkgbuild(run, src_path, pkgname, pkgver, other_files):
-    cwd = os.getcwd()
-    os.chdir(src_path)
-    try:
-        git_command = 'git commit'.split()
-        git_command.extend(other_files + ['PKGBUILD'])
-        git_command.extend([
-            '-m',"'Update pkg ({pkgver})'".format(pkgname=pkgname, pkgver=pkgver)])
-        run(' '.join(git_command))
-    except subprocess.CalledProcessError:
-        pass
-    finally:
-        os.chdir(cwd)
+ASSIGNMENT_PATTERN = re.compile(r'[ \t]*([A-Za-z_][A-Za-z0-9_]*)=')
+UNQUOTED_VALUE_PATTERN = re.compile(r'[^\s#]*')
+
+PkgbuildAssignment = collections.namedtuple('PkgbuildAssignment',
+        ['name', 'span', 'value_span', 'items'])
+PkgbuildAssignment.__doc__ = """An assignment of a PKGBUILD. `span` covers
+the whole assignment and `value_span` the value of an ordinary variable,
+without its quotes. `items` is None for an ordinary variable and the list of
+the spans of the quoted words of an array otherwise."""
+
+
+def find_closing_quote(content, pos):
+    """Return the position of the quote closing the one at `pos` or -1 if it
+    is not closed."""
+    quote = content[pos]
+    if quote == "'":
+        return content.find("'", pos + 1)
+    pos += 1
+    while True:
+        end = content.find('"', pos)
+        backslash = content.find('\\', pos, end)
+        if end == -1 or backslash == -1:
+            return end
+        pos = backslash + 2
+
+def scan_array_items(content, pos):
+    """Return the position after the array whose content starts at `pos` and
+    the spans of its quoted words."""
+    items = []
+    length = len(content)
+    while pos < length:
+        char = content[pos]
+        if char == ')':
+            return pos + 1, items
+        elif char in '"\'':
+            end = find_closing_quote(content, pos)
+            if end == -1:
+                break
+            items.append((pos + 1, end))
+            pos = end + 1
+        elif char == '#' and content[pos - 1] in ' \t\n(':
+            end = content.find('\n', pos)
+            pos = length if end == -1 else end
+        else:
+            pos += 1
+    return length, items
+
+def scan_pkgbuild(content):
+    """Yield the `PkgbuildAssignment` of every variable assigned at the start
+    of a line of the PKGBUILD `content`, reading it once."""
+    pos = 0
+    while pos < len(content):
+        match = ASSIGNMENT_PATTERN.match(content, pos)
+        if match is not None:
+            name, value_start = match.group(1), match.end()
+            if content.startswith('(', value_start):
+                end, items = scan_array_items(content, value_start + 1)
+                yield PkgbuildAssignment(name, (match.start(1), end),
+                        None, items)
+                pos = end
+            elif content.startswith(('"', "'"), value_start):
+                end = find_closing_quote(content, value_start)
+                if end != -1:
+                    yield PkgbuildAssignment(name, (match.start(1), end + 1),
+                            (value_start + 1, end), None)
+                    pos = end + 1
+            else:
+                end = UNQUOTED_VALUE_PATTERN.match(content, value_start).end()
+                yield PkgbuildAssignment(name, (match.start(1), end),
+                        (value_start, end), None)
+                pos = end
+        line_end = content.find('\n', pos)
+        if line_end == -1:
+            break
+        pos = line_end + 1
+
+class PkgbuildDocument(object):
+    """A PKGBUILD read once into an index of its variables. Edits are queued
+    and applied together by `render`, which leaves the rest of the content
+    untouched.
+
+    Like the `str.replace` based helpers, an edit applies to every assignment
+    of the variable whose text is the same as the first assignment. `changes`
+    maps each edited variable to its old and new values."""
+    def __init__(self, content):
+        self.content = content
+        self.assignments = {}
+        self.edits = {}
+        self.changes = collections.OrderedDict()
+        for assignment in scan_pkgbuild(content):
+            self.assignments.setdefault(assignment.name, []).append(assignment)
+
+    def get_assignments(self, var_name, is_array):
+        """Return the assignments of `var_name` which have the same text as
+        the first one."""
+        assignments = [assignment
+                for assignment in self.assignments.get(var_name, [])
+                if (assignment.items is not None) == is_array]
+        if not assignments:
+            raise ValueError('Variable "{}" not found in the script'.format(
+                var_name))
+        text = self.get_text(assignments[0].span)
+        return [assignment for assignment in assignments
+                if self.get_text(assignment.span) == text]
+
+    def get_text(self, span):
+        return self.content[span[0]:span[1]]
+
+    def has_value(self, var_name):
+        return any(assignment.items is None
+                for assignment in self.assignments.get(var_name, []))
+
+    def get_value(self, var_name):
+        assignment = self.get_assignments(var_name, False)[0]
+        return self.get_text(assignment.value_span)
+
+    def get_array_values(self, var_name):
+        assignment = self.get_assignments(var_name, True)[0]
+        return [self.get_text(span) for span in assignment.items]
+
+    def set_value(self, var_name, var_value):
+        """Queue the replacement of the value of the ordinary variable
+        `var_name`, keeping its quotes."""
+        self.changes[var_name] = (self.get_value(var_name), var_value)
+        for assignment in self.get_assignments(var_name, False):
+            self.edits[assignment.value_span] = var_value
+
+    def set_array_values(self, var_name, values):
+        """Queue the replacement of the quoted words of the array `var_name`
+        with `values`, in order."""
+        old_values = self.get_array_values(var_name)
+        self.changes[var_name] = (old_values, list(values[:len(old_values)]))
+        for assignment in self.get_assignments(var_name, True):
+            if len(values) < len(assignment.items):
+                raise IndexError('{} has {} quoted values, {} given'.format(
+                    var_name, len(assignment.items), len(values)))
+            for span, value in zip(assignment.items, values):
+                self.edits[span] = value
+
+    def render(self):
+        """Return the content with every queued edit applied."""
+        parts = []
+        pos = 0
+        for (start, end), value in sorted(self.edits.items()):
+            parts.append(self.content[pos:start])
+            parts.append(value)
+            pos = end
+        parts.append(self.content[pos:])
+        return ''.join(parts)
+
+PkgbuildUpdate = collections.namedtuple('PkgbuildUpdate',
+        ['pkgname', 'pkgver', 'changes', 'files', 'timings'])
+PkgbuildUpdate.__doc__ = """The planned update of a package to `pkgver`.
+`changes` maps the changed PKGBUILD variables to their old and new values,
+`files` maps the names of the files to write to their new content and
+`timings` maps the phases of the planning to their duration in seconds."""
+
+
+def format_timings(timings):
+    return ', '.join('{} {:.1f} ms'.format(phase, duration * 1000)
+            for phase, duration in timings.items())
+
+def format_update(update):
+    """Return a human readable description of the `PkgbuildUpdate`."""
+    lines = ['{} -> {}'.format(update.pkgname, update.pkgver)]
+    for var_name, (old_value, new_value) in update.changes.items():
+        if old_value == new_value:
+            continue
+        if isinstance(old_value, list):
+            old_value, new_value = ' '.join(old_value), ' '.join(new_value)
+        lines.append('    {}: {} -> {}'.format(var_name, old_value, new_value))
+    lines.append('    timings: {}'.format(format_timings(update.timings)))
+    return '\n'.join(lines)
+
+def write_update(src_path, update):
+    """Write the files of the `PkgbuildUpdate` in `src_path` and commit
+    them."""
+    for filename, content in update.files.items():
+        with open(os.path.join(src_path, filename), 'w') as f:
+            f.write(content)
+    other_files = [filename for filename in update.files
+            if filename != 'PKGBUILD']
+    commit_pkgbuild(src_path, update.pkgname, update.pkgver, other_files)
+
+def commit_pkgbuild(src_path, pkgname, pkgver, other_files):
+    """Commit the PKGBUILD and `other_files` in `src_path`. Raise
+    subprocess.CalledProcessError, with the standard error of git, if the
+    commit fails."""
+    git_lib.commit(src_path, 'Update pkg ({pkgver})'.format(
+        pkgname=pkgname, pkgver=pkgver), other_files + ['PKGBUILD'])
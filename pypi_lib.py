@@ -1,10 +1,129 @@
-from urllib.request import urlopen
+from http_lib import urlopen
+import collections
 import pkgbuild_lib
 import json
+import metrics_lib
 import os
+import pipeline_lib
+import re
+import verify_lib
 
 
-PYPI_JSON_URL_FORMAT_TEMPLATE = 'https://pypi.python.org/pypi/{}/json'
+PYPI_SIMPLE_URL_FORMAT_TEMPLATE = 'https://pypi.org/simple/{}/'
+PYPI_RELEASE_JSON_URL_FORMAT_TEMPLATE = 'https://pypi.org/pypi/{}/{}/json'
+PYPI_SIMPLE_JSON_CONTENT_TYPE = 'application/vnd.pypi.simple.v1+json'
+
+PEP440_VERSION_PATTERN = re.compile(r"""
+    v?(?:(?P<epoch>[0-9]+)!)?
+    (?P<release>[0-9]+(?:\.[0-9]+)*)
+    (?:[-_.]?(?P<pre_l>alpha|a|beta|b|preview|pre|c|rc)[-_.]?(?P<pre_n>[0-9]+)?)?
+    (?:-(?P<post_n1>[0-9]+)|[-_.]?(?P<post_l>post|rev|r)[-_.]?(?P<post_n2>[0-9]+)?)?
+    (?:[-_.]?(?P<dev_l>dev)[-_.]?(?P<dev_n>[0-9]+)?)?
+    (?:\+(?P<local>[a-z0-9]+(?:[-_.][a-z0-9]+)*))?
+    """, re.VERBOSE | re.IGNORECASE)
+PRE_RELEASE_RANKS = {'a': 0, 'alpha': 0, 'b': 1, 'beta': 1, 'c': 2, 'rc': 2,
+        'pre': 2, 'preview': 2}
+DIST_EXTENSIONS = ('.tar.gz', '.tar.bz2', '.tar.xz', '.tgz', '.zip', '.tar')
+
+PypiRelease = collections.namedtuple('PypiRelease', ['version', 'files'])
+PypiRelease.__doc__ = """The latest release of a PyPI project: its `version`
+and the description of its `files` by the JSON api."""
+
+
+def normalize_project_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def pep440_key(version):
+    """Return a key ordering versions like PEP 440 and telling whether
+    `version` is a pre-release, or None if it is not a valid version."""
+    match = PEP440_VERSION_PATTERN.fullmatch(version.strip())
+    if match is None:
+        return None
+    release = [int(i) for i in match.group('release').split('.')]
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+    is_post = (match.group('post_n1') is not None
+            or match.group('post_l') is not None)
+    post_n = match.group('post_n1') or match.group('post_n2') or 0
+    is_dev = match.group('dev_l') is not None
+    dev_n = match.group('dev_n') or 0
+    is_pre = match.group('pre_l') is not None
+
+    # Like in PEP 440, a dev release of a final version comes before its
+    # pre-releases, which come before the final version
+    if is_pre:
+        pre = (0, PRE_RELEASE_RANKS[match.group('pre_l').lower()],
+                int(match.group('pre_n') or 0))
+    elif is_dev and not is_post:
+        pre = (-1,)
+    else:
+        pre = (1,)
+    local = ()
+    if match.group('local') is not None:
+        local = tuple((1, int(part), '') if part.isdigit()
+                else (0, 0, part.lower())
+                for part in re.split(r'[-_.]', match.group('local')))
+    key = (int(match.group('epoch') or 0), tuple(release), pre,
+            (0, int(post_n)) if is_post else (-1,),
+            (0, int(dev_n)) if is_dev else (1,), local)
+    return key, is_pre or is_dev
+
+def get_filename_version(filename):
+    """Return the version in the name of a distribution file or None."""
+    if filename.endswith(('.whl', '.egg')):
+        parts = filename.split('-')
+        return parts[1] if len(parts) > 2 else None
+    for extension in DIST_EXTENSIONS:
+        if filename.endswith(extension):
+            name_version = filename[:-len(extension)]
+            return name_version.rsplit('-', 1)[-1] if (
+                    '-' in name_version) else None
+    return None
+
+def get_latest_version(project):
+    """Return the latest version of `project` given its PEP 691 project
+    page: the highest version which is not a pre-release and has files
+    that are not all yanked, or the highest pre-release if there are only
+    pre-releases."""
+    file_keys, yanked_keys = set(), set()
+    for dist_file in project.get('files', []):
+        version = get_filename_version(dist_file['filename'])
+        version_key = pep440_key(version) if version is not None else None
+        if version_key is None:
+            continue
+        if dist_file.get('yanked'):
+            yanked_keys.add(version_key[0])
+        else:
+            file_keys.add(version_key[0])
+    yanked_keys -= file_keys
+
+    versions = project.get('versions') or [
+            get_filename_version(dist_file['filename'])
+            for dist_file in project.get('files', [])]
+    candidates = []
+    for version in versions:
+        version_key = pep440_key(version) if version is not None else None
+        if version_key is not None and version_key[0] not in yanked_keys:
+            candidates.append((not version_key[1], version_key[0], version))
+    if not candidates:
+        return None
+    return max(candidates)[2]
+
+def get_latest_release(pypi_pkgname):
+    """Return the `PypiRelease` of the latest version of `pypi_pkgname`.
+    The version is found from the PEP 691 simple json page and the files
+    from the json of that version only, instead of the json of the project
+    which describes every release ever made."""
+    with urlopen(PYPI_SIMPLE_URL_FORMAT_TEMPLATE.format(
+            normalize_project_name(pypi_pkgname)),
+            headers={'Accept': PYPI_SIMPLE_JSON_CONTENT_TYPE}) as page:
+        version = get_latest_version(json.loads(page.read()))
+    if version is None:
+        raise ValueError('{} has no release'.format(pypi_pkgname))
+    with urlopen(PYPI_RELEASE_JSON_URL_FORMAT_TEMPLATE.format(pypi_pkgname,
+            version)) as release:
+        files = json.loads(release.read())['urls']
+    return PypiRelease(version, files)
 
 
 def get_checksums(release):
@@ -17,44 +136,82 @@ def get_checksums(release):
     return checksums
 
 
-def update_package_with_pypi(run, pkgbuild_dir):
-    pkgbuild_path = os.path.join(pkgbuild_dir, 'PKGBUILD')
-    with open(pkgbuild_path, 'r') as pkgbuild:
-        pkgbuild_content = pkgbuild.read()
-
-    pypi_pkgname = pkgbuild_lib.get_pkgbuild_value(pkgbuild_content, '_pypi_pkgname')
-    with urlopen(PYPI_JSON_URL_FORMAT_TEMPLATE.format(pypi_pkgname)) as pypi_pkg_fp:
-        pypi_pkg_content = pypi_pkg_fp.read().decode('utf-8')
-        pypi_pkg = json.loads(pypi_pkg_content)
-
-    new_pkgver = pypi_pkg['info']['version']
-    pkgver = pkgbuild_lib.get_pkgbuild_value(pkgbuild_content, 'pkgver')
-    vercmp_res = pkgbuild_lib.vercmp(run, pkgver, new_pkgver)
-    pkgname = pkgbuild_lib.get_pkgbuild_value(pkgbuild_content, 'pkgname')
-    if vercmp_res >= 0:
-        print('{} already updated'.format(pkgname))
-        return
-
-    pkgbuild_content = pkgbuild_lib.replace_pkgbuild_var_value(
-            pkgbuild_content, 'pkgver', new_pkgver)
-    pkgbuild_content = pkgbuild_lib.replace_pkgbuild_var_value(
-            pkgbuild_content, 'pkgrel', '1')
-
-    for latest_release in pypi_pkg['releases'][new_pkgver]:
-        if latest_release['packagetype'] == 'sdist':
-            source_release = latest_release
-
-    checksums = get_checksums(source_release)
-    for checksum_name, value in checksums.items():
-        try:
-            bash_array, array_pattern = pkgbuild_lib.extract_array_var_pattern(
-                pkgbuild_content, checksum_name)
-            pkgbuild_content = pkgbuild_content.replace(bash_array,
-                    array_pattern.format(value))
-        except ValueError:
-            pass
-
-    with open(pkgbuild_path, 'w') as pkgbuild:
-        pkgbuild.write(pkgbuild_content)
-    pkgbuild_lib.commit_pkgbuild(run, pkgbuild_dir,
-            pkgname, new_pkgver, [])
+def get_source_release(files):
+    """Return the sdist among the released `files`."""
+    for release in files:
+        if release['packagetype'] == 'sdist':
+            source_release = release
+    return source_release
+
+
+def fetch(job):
+    pypi_pkgname = job.upstream.get('pypi_name')
+    if pypi_pkgname is None:
+        pypi_pkgname = pipeline_lib.read_pkgbuild(job).get_value(
+                '_pypi_pkgname')
+    with metrics_lib.timed(job.timings, 'fetch'):
+        job.data['release'] = get_latest_release(pypi_pkgname)
+    return job
+
+
+def parse(job):
+    with metrics_lib.timed(job.timings, 'parse'):
+        latest_release = job.data['release']
+        job.upstream_version = latest_release.version
+        job.data['source_release'] = get_source_release(latest_release.files)
+        job.upstream_checksum = json.dumps(
+                get_checksums(job.data['source_release']), sort_keys=True)
+        return pipeline_lib.parse_unless_unchanged(job)
+
+
+def compare(job):
+    with metrics_lib.timed(job.timings, 'compare'):
+        pkgver = job.pkgbuild.get_value('pkgver')
+        if pkgbuild_lib.vercmp(pkgver, job.upstream_version) >= 0:
+            return pipeline_lib.set_up_to_date(job)
+    return job
+
+
+def rewrite(job):
+    with metrics_lib.timed(job.timings, 'rewrite'):
+        pkgbuild = job.pkgbuild
+        pkgbuild.set_value('pkgver', job.upstream_version)
+        pkgbuild.set_value('pkgrel', '1')
+
+        checksums = get_checksums(job.data['source_release'])
+        written_checksums = {}
+        for checksum_name, value in checksums.items():
+            try:
+                pkgbuild.set_array_values(checksum_name, [value])
+            except ValueError:
+                continue
+            written_checksums[checksum_name] = value
+        job.sources = [verify_lib.make_source_file(
+            job.data['source_release']['url'], written_checksums)]
+        return pipeline_lib.plan_update(job, {'PKGBUILD': pkgbuild.render()})
+
+
+def make_pipeline_source(src_parent, entries, dry_run=False):
+    """Return the `pipeline_lib.PipelineSource` of the PyPI packages of the
+    manifest `entries`, whose PKGBUILDs are in `src_parent`."""
+    def discover():
+        return [pipeline_lib.PackageJob(source,
+            os.path.join(src_parent, entry.name), entry.upstream, dry_run)
+            for entry in entries]
+    source = pipeline_lib.PipelineSource('pypi', discover, fetch, parse,
+            compare, rewrite)
+    return source
+
+
+def update_package_with_pypi(pkgbuild_dir, dry_run=False,
+        pypi_pkgname=None, verify=False):
+    """Update the PKGBUILD in `pkgbuild_dir` to the latest release of
+    `pypi_pkgname`, or of its `_pypi_pkgname` if not given, and commit it.
+    Return the `pkgbuild_lib.PkgbuildUpdate` or None if the package is
+    already updated. When `dry_run` is true, nothing is written nor
+    committed. When `verify` is true, the sdist is downloaded and checked
+    against its checksums first."""
+    upstream = {} if pypi_pkgname is None else {'pypi_name': pypi_pkgname}
+    source = make_pipeline_source(os.path.dirname(pkgbuild_dir), [])
+    return pipeline_lib.run_job(pipeline_lib.PackageJob(source, pkgbuild_dir,
+        upstream, dry_run), verify)
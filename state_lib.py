@@ -0,0 +1,72 @@
+import cache_lib
+import collections
+import hashlib
+import metrics_lib
+import os
+import threading
+
+
+PACKAGE_STATES_CACHE_NAME = 'package-states.json'
+
+_package_states_lock = threading.Lock()
+
+PackageState = collections.namedtuple('PackageState',
+        ['upstream_version', 'upstream_checksum', 'pkgbuild_hash'])
+PackageState.__doc__ = """What a run saw of a package: the latest version
+upstream, a checksum identifying that upstream release and the hash of the
+PKGBUILD once the package was up to date."""
+
+
+def get_package_key(src_path):
+    """Return the key of the package at `src_path` in the state store."""
+    return os.path.basename(os.path.normpath(src_path))
+
+def get_content_hash(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+def get_pkgbuild_hash(src_path):
+    """Return the hash of the PKGBUILD in `src_path`."""
+    with open(os.path.join(src_path, 'PKGBUILD'), 'rb') as f:
+        return get_content_hash(f.read())
+
+def get_package_state(src_path):
+    """Return the `PackageState` of the package at `src_path` recorded by a
+    previous run or None."""
+    with _package_states_lock:
+        package_states = cache_lib.load_json(PACKAGE_STATES_CACHE_NAME, {})
+    package_state = package_states.get(get_package_key(src_path))
+    if package_state is None:
+        return None
+    return PackageState(**package_state)
+
+def set_package_state(src_path, upstream_version, upstream_checksum,
+        pkgbuild_content=None):
+    """Record that the package at `src_path` is up to date with
+    `upstream_version`. The PKGBUILD is hashed from `pkgbuild_content` when
+    given, from the file otherwise."""
+    if pkgbuild_content is None:
+        pkgbuild_hash = get_pkgbuild_hash(src_path)
+    else:
+        pkgbuild_hash = get_content_hash(pkgbuild_content)
+    package_state = PackageState(upstream_version, upstream_checksum,
+            pkgbuild_hash)
+    with _package_states_lock:
+        package_states = cache_lib.load_json(PACKAGE_STATES_CACHE_NAME, {})
+        package_states[get_package_key(src_path)] = package_state._asdict()
+        cache_lib.save_json(PACKAGE_STATES_CACHE_NAME, package_states)
+
+def is_package_unchanged(src_path, upstream_version, upstream_checksum):
+    """Return whether neither upstream nor the PKGBUILD in `src_path` changed
+    since the package was last recorded up to date, in which case there is
+    no need to parse the PKGBUILD nor to compare versions. Raise
+    FileNotFoundError if `src_path` has no PKGBUILD."""
+    pkgbuild_hash = get_pkgbuild_hash(src_path)
+    unchanged = get_package_state(src_path) == PackageState(upstream_version,
+            upstream_checksum, pkgbuild_hash)
+    if unchanged:
+        metrics_lib.add('cache_hits_total', cache='package_state')
+    else:
+        metrics_lib.add('cache_misses_total', cache='package_state')
+    return unchanged
@@ -1,148 +1,202 @@
 from invoke import ctask, Collection
-from urllib.request import urlopen
 import android_repository_lib as android_repo_lib
+import concurrent.futures
 import dsc_lib
-import ftplib
+import fetch_lib
 import functools
-import itertools
+import git_lib
+import manifest_lib
+import metrics_lib
 import os
+import pipeline_lib
 import pkgbuild_lib
-import urllib
 import pypi_lib
+import subprocess
+import time
 
 
 DEFAULT_PKGBUILD_SRC_PARENT_PATH = os.path.join(
         os.path.dirname(__file__), os.path.pardir, 'aur-packages')
 
 
-def out(ctx):
-    def run(*args, **kwargs):
-        res = ctx.run(*args, hide='both', **kwargs)
-        return res.stdout
-    return run
-
-
-def get_latest_lubuntu_artwork_dsc(run):
-    base_url = 'archive.ubuntu.com'
-    directory = 'ubuntu/pool/universe/l/lubuntu-artwork'
-    with ftplib.FTP(base_url) as ftp:
-        ftp.login()
-        ftp.cwd(directory)
-        dsc_list = []
-        for i in ftp.nlst():
-            if i.endswith('.dsc'):
-                dsc_list.append(i)
-
-        dsc_list = list(sorted(dsc_list, key=functools.cmp_to_key(
-            lambda *args, **kwargs: pkgbuild_lib.vercmp(run, *args,
-                **kwargs))))
-        dsc_name = dsc_list[-1]
-    path_to_dsc = os.path.join(directory, dsc_name)
-    url = urllib.parse.urljoin('http://{}'.format(base_url), path_to_dsc)
-    return url
+def print_update(update, dry_run):
+    if update is not None and dry_run:
+        print(pkgbuild_lib.format_update(update))
+
+
+def get_manifest_entries(manifest, updater, force):
+    """Return the entries of `manifest` that follow `updater` and are due,
+    or all of them when `force` is true."""
+    entries = [entry for entry in manifest_lib.load_manifest(manifest)
+            if entry.updater == updater]
+    if not force:
+        entries = manifest_lib.get_due_entries(entries)
+    return entries
+
+
+def run_pipeline(sources, dry_run, stage_workers=None, verify=False,
+        deadline=None, timeout=None):
+    """Update the packages of `sources` in the pipeline, printing each
+    outcome as soon as it is known. The check time of the packages of the
+    manifest is recorded when they succeed. With `verify`, the upstream
+    files are checked against their checksums before committing. Nothing
+    is fetched after `deadline` seconds and a request times out after
+    `timeout` seconds."""
+    fetch_lib.configure(timeout=timeout, deadline=deadline)
+
+    def print_result(result):
+        if result.status == 'timed out':
+            print('{}: timed out'.format(result.name or result.source))
+            return
+        if result.error is not None:
+            print('{}: failed: {!r}'.format(result.name or result.source,
+                result.error))
+            return
+        print_update(result.update, dry_run)
+        if not dry_run and result.source in manifest_lib.UPDATERS:
+            manifest_lib.set_last_check(result.name, time.time())
+
+    results = pipeline_lib.run_pipeline(sources, stage_workers,
+            on_result=print_result, verify=verify)
+    print(pipeline_lib.format_summary(results))
+    return results
 
 
 @ctask
 def update_android_packages(ctx,
         android_pkgbuild_src_parent=DEFAULT_PKGBUILD_SRC_PARENT_PATH,
-        exclude_codename=None):
-
-    package_list_open_urls = [urllib.request.urlopen(i)
-            for i in itertools.chain.from_iterable(
-                android_repo_lib.get_addon_url_paths().values())]
-    package_list_open_urls.append(android_repo_lib.get_repository_xml_url())
-
-    android_items = android_repo_lib.get_android_items(package_list_open_urls)
-    android_items = [item for item in android_items
-            if item.package_type != 'extra' and 'obsolete' not in item]
-    items_by_package_name = {}
-    for item in android_items:
-        android_pkg_name = android_repo_lib.get_android_package_name(item)
-        items_by_package_name.setdefault(android_pkg_name, [])
-        items_by_package_name[android_pkg_name].append(item)
-
-    latest_packages = {}
-    for package_name, items in items_by_package_name.items():
-        pkgs = []
-        for itm in items:
-            try:
-                if itm.codename != exclude_codename:
-                    pkgs.append(itm)
-            except AttributeError:
-                pkgs.append(itm)
-        pkgs = sorted(pkgs, key=android_repo_lib.get_android_version, reverse=True)
-        if pkgs:
-            latest_packages[package_name] = pkgs[0]
-
-    for package_name, item in latest_packages.items():
-        pkgbuild_src = os.path.join(android_pkgbuild_src_parent,
-            android_repo_lib.to_aur_package_name(package_name))
-        try:
-            android_repo_lib.update_package(out(ctx), pkgbuild_src, item)
-        except FileNotFoundError:
-            pass
+        exclude_codename=None, max_workers=8, jobs=None, dry_run=False,
+        verify=False, deadline=None, timeout=None):
+    """Update the android packages. The repositories are fetched by
+    --max-workers threads. With --jobs, that many packages are parsed,
+    compared, rewritten and committed at once in each of these stages. With
+    --verify, the archives are downloaded and checked against their
+    checksums before committing. Packages not fetched --deadline seconds
+    after the start are reported as timed out; requests time out after
+    --timeout seconds."""
+    stage_workers = None
+    if jobs is not None:
+        stage_workers = {stage: int(jobs)
+                for stage in ('parse', 'compare', 'rewrite', 'commit')}
+    with metrics_lib.report('update_android_packages'):
+        run_pipeline([android_repo_lib.make_pipeline_source(
+            android_pkgbuild_src_parent, exclude_codename, max_workers,
+            dry_run)], dry_run, stage_workers, verify, deadline, timeout)
 
 
 @ctask
 def update_packages_that_have_dsc(ctx,
-        src_parent=DEFAULT_PKGBUILD_SRC_PARENT_PATH):
-    pkgbuild_dirs = []
-    for i in ['lubuntu-artwork', 'xapian-omega']:
-        pkgbuild_dirs.append(os.path.join(src_parent, i))
-
-    urls = [get_latest_lubuntu_artwork_dsc(out(ctx)),
-            dsc_lib.get_dsc_url_from_debian_package_page('xapian-omega')]
-
-    pkg_source_name_patterns = ['lubuntu-artwork_{}.',
-            'xapian-omega_{}.orig.tar.xz']
-
-    for src_path, url, pkg_src_name_pattern in zip(
-            pkgbuild_dirs, urls, pkg_source_name_patterns):
-        dsc_lib.update_package_with_dsc(out(ctx), src_path, url, pkg_src_name_pattern)
+        src_parent=DEFAULT_PKGBUILD_SRC_PARENT_PATH,
+        manifest=manifest_lib.DEFAULT_MANIFEST_PATH, max_jobs=4,
+        dry_run=False, force=False, verify=False, deadline=None,
+        timeout=None):
+    """Update the dsc packages of the manifest that are due, fetching at
+    most --max-jobs of them at once. With --force, update them even if they
+    were checked recently. With --verify, the source files are downloaded
+    and checked against their checksums before committing. --deadline and
+    --timeout are as for update_android_packages."""
+    with metrics_lib.report('update_packages_that_have_dsc'):
+        run_pipeline([dsc_lib.make_pipeline_source(src_parent,
+            get_manifest_entries(manifest, 'dsc', force), dry_run)],
+            dry_run, {'fetch': int(max_jobs)}, verify, deadline, timeout)
 
 
 @ctask
 def update_pypi_packages(ctx,
-        src_parent=DEFAULT_PKGBUILD_SRC_PARENT_PATH):
-    pkgbuild_dirs = []
-    for i in ['pyhamcrest']:
-        pkgbuild_dirs.append(os.path.join(src_parent, i))
+        src_parent=DEFAULT_PKGBUILD_SRC_PARENT_PATH,
+        manifest=manifest_lib.DEFAULT_MANIFEST_PATH, max_jobs=4,
+        dry_run=False, force=False, verify=False, deadline=None,
+        timeout=None):
+    """Update the PyPI packages of the manifest that are due, fetching at
+    most --max-jobs of them at once. With --force, update them even if they
+    were checked recently. With --verify, the sdists are downloaded and
+    checked against their checksums before committing. --deadline and
+    --timeout are as for update_android_packages."""
+    with metrics_lib.report('update_pypi_packages'):
+        run_pipeline([pypi_lib.make_pipeline_source(src_parent,
+            get_manifest_entries(manifest, 'pypi', force), dry_run)],
+            dry_run, {'fetch': int(max_jobs)}, verify, deadline, timeout)
 
-    for src_path in pkgbuild_dirs:
-        pypi_lib.update_package_with_pypi(out(ctx), src_path)
 
-
-@ctask(pre=[update_android_packages,
-    update_packages_that_have_dsc,
-    update_pypi_packages])
-def update_packages(ctx):
-    print("Finish updating packages")
+@ctask
+def update_packages(ctx, src_parent=DEFAULT_PKGBUILD_SRC_PARENT_PATH,
+        manifest=manifest_lib.DEFAULT_MANIFEST_PATH, max_jobs=8,
+        dry_run=False, force=False, verify=False, deadline=None,
+        timeout=None):
+    """Update every package. The android, dsc and PyPI packages go through
+    the same pipeline at the same time, fetching at most --max-jobs of them
+    at once. With --dry-run, print the planned updates without writing
+    files, committing nor recording the state of the packages; only the
+    caches of what was fetched upstream and the metrics reports are still
+    written. With --force, update the packages of the manifest even if
+    they were checked recently. With --verify, the upstream files are
+    downloaded and checked against their checksums before committing. With
+    --deadline, nothing is fetched after that many seconds and the packages
+    left are reported as timed out, so that a stalled upstream cannot hold
+    the run; requests time out after --timeout seconds."""
+    with metrics_lib.report('update_packages'):
+        run_pipeline([
+            android_repo_lib.make_pipeline_source(src_parent,
+                dry_run=dry_run),
+            dsc_lib.make_pipeline_source(src_parent,
+                get_manifest_entries(manifest, 'dsc', force), dry_run),
+            pypi_lib.make_pipeline_source(src_parent,
+                get_manifest_entries(manifest, 'pypi', force), dry_run),
+        ], dry_run, {'fetch': int(max_jobs)}, verify, deadline, timeout)
+        print("Finish updating packages")
+
+
+def push_and_pull(git_dir):
+    """Push the repository at `git_dir` to all_remotes and pull it back from
+    origin. Return None on success, the error of git otherwise."""
+    try:
+        git_lib.run_git(git_dir, 'push', 'all_remotes')
+        git_lib.run_git(git_dir, 'pull', 'origin', 'master')
+    except subprocess.CalledProcessError as e:
+        return e.stderr.strip() or str(e)
+    return None
 
 
 @ctask
 def push_to_remote(ctx,
-        src_parent=DEFAULT_PKGBUILD_SRC_PARENT_PATH):
-    rn = out(ctx)
-    for i in os.listdir(src_parent):
-        git_dir = os.path.join(src_parent, i)
-        if not os.path.isdir(git_dir):
-            continue
-
-        # Skip directory that is not git repository
-        res = ctx.run("git -C '{}' rev-parse".format(git_dir), hide='both')
-        if res.exited != 0:
-            continue
-
-        # Count the number of commits that are not pushed yet in the
-        # remote branch
-        rev_count = rn(' '.join(["git -C '{}'".format(git_dir),
-            "rev-list --count all_remotes/master..HEAD"]))
-        rev_count = int(rev_count)
-
-        if rev_count > 0:
-            print('{} is {} commit(s) ahead of all_remotes'.format(i, rev_count))
-            ctx.run("git -C '{}' push all_remotes".format(git_dir))
-            ctx.run("git -C '{}' pull origin master".format(git_dir))
+        src_parent=DEFAULT_PKGBUILD_SRC_PARENT_PATH, max_workers=8):
+    with metrics_lib.report('push_to_remote'):
+        git_dirs = [os.path.join(src_parent, i)
+                for i in sorted(os.listdir(src_parent))
+                if os.path.isdir(os.path.join(src_parent, i))]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            # Count the number of commits that are not pushed yet in the
+            # remote branch. Directories that are not git repositories are
+            # skipped.
+            rev_counts = executor.map(functools.partial(
+                git_lib.get_ahead_count, remote_ref='all_remotes/master'),
+                git_dirs)
+            ahead_git_dirs = []
+            for git_dir, rev_count in zip(git_dirs, rev_counts):
+                if rev_count:
+                    print('{} is {} commit(s) ahead of all_remotes'.format(
+                        os.path.basename(git_dir), rev_count))
+                    ahead_git_dirs.append(git_dir)
+
+            errors = executor.map(push_and_pull, ahead_git_dirs)
+            for git_dir, error in zip(ahead_git_dirs, errors):
+                name = os.path.basename(git_dir)
+                if error is None:
+                    print('{}: pushed'.format(name))
+                else:
+                    print('{}: failed: {}'.format(name, error))
+
+
+@ctask
+def benchmark(ctx, name=None, update_baseline=False):
+    """Run the offline benchmarks, or only the one called `name`, and fail
+    if any of them regressed compared with the stored baseline. With
+    --update-baseline, store the results as the new baseline instead."""
+    # Imported here so that the other tasks do not load the benchmarks
+    import benchmarks
+    if benchmarks.main([name] if name else None, update_baseline):
+        raise SystemExit(1)
 
 
 ns = Collection()
@@ -150,4 +204,5 @@ ns.add_task(update_android_packages)
 ns.add_task(update_packages_that_have_dsc)
 ns.add_task(update_pypi_packages)
 ns.add_task(push_to_remote)
+ns.add_task(benchmark)
 ns.add_task(update_packages, default=True)
@@ -0,0 +1,67 @@
+import android_repository_lib as android_repo_lib
+import io
+import unittest
+
+
+SYS_IMG2_HEADER = ('<?xml version="1.0" ?>\n'
+        '<sys-img:sdk-sys-img xmlns:sys-img="http://schemas.android.com/sdk/'
+        'android/repo/sys-img2/01" xmlns:xsi='
+        '"http://www.w3.org/2001/XMLSchema-instance">\n'
+        '<license id="android-sdk-license" type="text">Terms</license>\n')
+SYS_IMG2_PACKAGE = '''<remotePackage path="system-images;android-{api_level};default;{abi}">
+  <type-details xsi:type="sys-img:detailsType">
+    <api-level>{api_level}</api-level>
+    <tag><id>default</id><display>Default</display></tag>
+    <abi>{abi}</abi>
+  </type-details>
+  <revision><major>{major}</major></revision>
+  <display-name>System Image</display-name>
+  <uses-license ref="android-sdk-license"/>
+  <archives>
+    <archive>
+      <complete><size>1</size><checksum>{abi}</checksum><url>{abi}.zip</url></complete>
+    </archive>
+  </archives>
+</remotePackage>
+'''
+
+
+class NamedBytesIO(io.BytesIO):
+    def __init__(self, content, url):
+        super().__init__(content)
+        self.url = url
+
+
+def make_sys_img2_items(packages):
+    """Return the items of a sys-img2 document with a remotePackage for
+    each (api level, abi, major revision) of `packages`."""
+    content = SYS_IMG2_HEADER + ''.join(SYS_IMG2_PACKAGE.format(
+        api_level=api_level, abi=abi, major=major)
+        for api_level, abi, major in packages) + '</sys-img:sdk-sys-img>\n'
+    return android_repo_lib.get_android_items([NamedBytesIO(
+        content.encode('utf-8'), 'https://example.com/sys-img.xml')])
+
+
+class AndroidCatalogTest(unittest.TestCase):
+
+    def test_items_of_the_same_version(self):
+        items = make_sys_img2_items([(30, 'x86', 1), (30, 'x86_64', 1),
+            (30, 'arm64-v8a', 1)])
+        catalog = android_repo_lib.AndroidCatalog(items)
+        self.assertEqual(list(catalog.latest), ['sys-img'])
+        # Like a stable sort, the first item of the latest version wins
+        self.assertIs(catalog.latest['sys-img'], items[0])
+        self.assertEqual(android_repo_lib.get_android_version(items[0]),
+                (30, 1, 0, 0))
+
+    def test_versions_are_compared_as_numbers(self):
+        items = make_sys_img2_items([(9, 'x86', 10), (10, 'x86', 9),
+            (10, 'x86_64', 10)])
+        catalog = android_repo_lib.AndroidCatalog(items)
+        self.assertIs(catalog.latest['sys-img'], items[2])
+        self.assertIs(android_repo_lib.get_latest_packages(catalog)[
+            'sys-img'], items[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
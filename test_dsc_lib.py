@@ -0,0 +1,180 @@
+import dsc_lib
+import os
+import pipeline_lib
+import pkgbuild_lib
+import tempfile
+import unittest
+import unittest.mock
+import urllib.parse
+import urllib.request
+
+
+# Several versions of tzdata, in no particular order, a package whose .dsc
+# is only listed in Files and one whose .dsc is only listed in
+# Checksums-Sha256
+SOURCES = '''Package: tzdata
+Binary: tzdata
+Version: 2024a-1
+Directory: pool/main/t/tzdata
+Files:
+ 0123456789abcdef0123456789abcdef 2000 tzdata_2024a-1.dsc
+ 0123456789abcdef0123456789abcdef 9000 tzdata_2024a-1.debian.tar.xz
+Checksums-Sha256:
+ {sha256} 2000 tzdata_2024a-1.dsc
+ {sha256} 9000 tzdata_2024a-1.debian.tar.xz
+
+Package: tzdata
+Binary: tzdata
+Version: 2024b-3
+Directory: pool/main/t/tzdata
+Files:
+ 0123456789abcdef0123456789abcdef 2000 tzdata_2024b-3.dsc
+Checksums-Sha256:
+ {sha256} 2000 tzdata_2024b-3.dsc
+
+Package: tzdata
+Binary: tzdata
+Version: 2024b-10
+Directory: pool/main/t/tzdata
+Files:
+ 0123456789abcdef0123456789abcdef 2000 tzdata_2024b-10.dsc
+Checksums-Sha256:
+ {sha256} 2000 tzdata_2024b-10.dsc
+
+Package: files-only
+Version: 1:1.0-1
+Directory: pool/main/f/files-only
+Files:
+ 0123456789abcdef0123456789abcdef 2000 files-only_1.0-1.dsc
+ 0123456789abcdef0123456789abcdef 9000 files-only_1.0.orig.tar.gz
+
+Package: sha256-only
+Version: 2.0-1
+Directory: pool/main/s/sha256-only
+Checksums-Sha256:
+ {sha256} 9000 sha256-only_2.0.orig.tar.gz
+ {sha256} 2000 sha256-only_2.0-1.dsc
+Homepage: https://example.com/sha256-only
+'''.format(sha256='0' * 64)
+
+
+DSC = '''Format: 3.0 (quilt)
+Source: xapian-omega
+Version: 1.4.22-1
+Files:
+ 0123456789abcdef0123456789abcdef 9000 xapian-omega_1.4.22.orig.tar.xz
+'''
+DSC_CHECKSUMS = '''Checksums-Sha1:
+ {sha1} 9000 xapian-omega_1.4.22.orig.tar.xz
+Checksums-Sha256:
+ {sha256} 9000 xapian-omega_1.4.22.orig.tar.xz
+'''.format(sha1='1' * 40, sha256='2' * 64)
+PKGBUILD = '''pkgname=xapian-omega
+pkgver=1.4.21
+pkgrel=2
+source=("https://example.com/xapian-omega_${pkgver}.orig.tar.xz")
+sha256sums=('0000')
+'''
+
+
+def rewrite_dsc(dsc_content):
+    """Return the job of the PKGBUILD rewritten from `dsc_content`."""
+    job = pipeline_lib.PackageJob(None, 'xapian-omega',
+            {'source_name_pattern': 'xapian-omega_{}.orig'})
+    job.pkgbuild = pkgbuild_lib.PkgbuildDocument(PKGBUILD)
+    job.data = {'dsc_url': 'https://example.com/x/xapian-omega_1.4.22-1.dsc',
+            'dsc_content': dsc_content}
+    job.upstream_version = '1.4.22'
+    return dsc_lib.rewrite(job)
+
+
+class DscTest(unittest.TestCase):
+
+    def test_source_file_name(self):
+        self.assertEqual(dsc_lib.get_source_file_name(DSC + DSC_CHECKSUMS,
+            'xapian-omega_1.4.22.orig'), 'xapian-omega_1.4.22.orig.tar.xz')
+        self.assertIsNone(dsc_lib.get_source_file_name(DSC,
+            'xapian-omega_1.4.22.orig'))
+
+    def test_rewrite(self):
+        job = rewrite_dsc(DSC + DSC_CHECKSUMS)
+        self.assertIn("sha256sums=('{}')".format('2' * 64),
+                job.update.files['PKGBUILD'])
+        source, = job.sources
+        self.assertEqual(source.url, 'https://example.com/x/'
+                'xapian-omega_1.4.22.orig.tar.xz')
+        self.assertEqual(source.checksums, {'sha256': '2' * 64})
+
+    def test_rewrite_without_checksums(self):
+        job = rewrite_dsc(DSC)
+        self.assertIn('pkgver=1.4.22\n', job.update.files['PKGBUILD'])
+        self.assertEqual(job.sources, [])
+
+
+class SourcesIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        mirror_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(mirror_dir.cleanup)
+        self.mirror_url = urllib.parse.urljoin('file:',
+                urllib.request.pathname2url(mirror_dir.name) + '/')
+        for compression, open_file in dsc_lib.SOURCES_INDEX_OPENERS.items():
+            path = os.path.join(mirror_dir.name, 'dists', 'sid', 'main',
+                    'source', 'Sources' + compression)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open_file(path, 'wt', encoding='utf-8') as f:
+                f.write(SOURCES)
+        patcher = unittest.mock.patch.object(dsc_lib, '_sources_indexes', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_dsc_url(self, path):
+        return urllib.parse.urljoin(self.mirror_url, path)
+
+    def test_latest_version(self):
+        for compression in dsc_lib.SOURCES_INDEX_OPENERS:
+            with self.subTest(compression=compression):
+                package = dsc_lib.get_sources_index(
+                        mirror_url=self.mirror_url,
+                        compression=compression)['tzdata']
+                self.assertEqual(package.version, '2024b-10')
+                self.assertEqual(package.dsc_url, self.get_dsc_url(
+                    'pool/main/t/tzdata/tzdata_2024b-10.dsc'))
+
+    def test_dsc_listed_in_files_or_checksums(self):
+        self.assertEqual(dsc_lib.get_dsc_urls_from_sources_index(
+            ['files-only', 'sha256-only'], mirror_url=self.mirror_url), {
+                'files-only': self.get_dsc_url(
+                    'pool/main/f/files-only/files-only_1.0-1.dsc'),
+                'sha256-only': self.get_dsc_url(
+                    'pool/main/s/sha256-only/sha256-only_2.0-1.dsc'),
+            })
+
+    def test_missing_package(self):
+        self.assertEqual(dsc_lib.get_dsc_urls_from_sources_index(
+            ['tzdata', 'missing'], mirror_url=self.mirror_url), {
+                'tzdata': self.get_dsc_url(
+                    'pool/main/t/tzdata/tzdata_2024b-10.dsc'),
+            })
+        with unittest.mock.patch.dict(os.environ,
+                {'AUR_TOOLS_DEBIAN_MIRROR': self.mirror_url}):
+            with self.assertRaises(KeyError):
+                dsc_lib.get_upstream_dsc_url({'debian_package': 'missing'})
+
+    def test_mirror_from_environment(self):
+        with unittest.mock.patch.dict(os.environ,
+                {'AUR_TOOLS_DEBIAN_MIRROR': self.mirror_url.rstrip('/')}):
+            self.assertEqual(dsc_lib.get_upstream_dsc_url(
+                {'debian_package': 'sha256-only'}), self.get_dsc_url(
+                    'pool/main/s/sha256-only/sha256-only_2.0-1.dsc'))
+
+    def test_parsed_once(self):
+        index = dsc_lib.get_sources_index(mirror_url=self.mirror_url)
+        os.unlink(urllib.request.url2pathname(urllib.parse.urlsplit(
+            dsc_lib.get_sources_index_url(mirror_url=self.mirror_url)).path))
+        self.assertIs(dsc_lib.get_sources_index(mirror_url=self.mirror_url),
+                index)
+
+
+if __name__ == '__main__':
+    unittest.main()
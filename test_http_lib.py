@@ -0,0 +1,213 @@
+import android_repository_lib as android_repo_lib
+import fetch_lib
+import gzip
+import http.server
+import http_lib
+import metrics_lib
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import urllib.error
+
+
+BODY = b'<sdk>' + b'package ' * 1024 + b'</sdk>'
+ETAG = '"v1"'
+# Number of failures of /flaky before it succeeds
+FLAKY_FAILURES = 2
+SERVER_POLL_INTERVAL = 0.01
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serve the paths requested by the tests and record each request in
+    `server.requests` as (method, path, client port)."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def handle_request(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path,
+                self.client_address[1]))
+            count = sum(1 for _, path, _ in self.server.requests
+                    if path == self.path)
+        if (self.path in ('/etag', '/gzip-etag')
+                and self.headers.get('If-None-Match') == ETAG):
+            self.send_body(304, headers={'ETag': ETAG})
+        elif self.path == '/etag':
+            self.send_body(200, BODY, {'ETag': ETAG})
+        elif self.path in ('/gzip', '/gzip-etag'):
+            headers = {'Content-Encoding': 'gzip'}
+            if self.path == '/gzip-etag':
+                headers['ETag'] = ETAG
+            self.send_body(200, gzip.compress(BODY), headers)
+        elif self.path == '/redirect':
+            self.send_body(302, headers={'Location': '/etag'})
+        elif self.path == '/no-head':
+            if self.command == 'HEAD':
+                self.send_body(405)
+            else:
+                self.send_body(200, BODY)
+        elif self.path == '/flaky':
+            if count <= FLAKY_FAILURES:
+                self.send_body(503)
+            else:
+                self.send_body(200, BODY)
+        elif self.path == '/down':
+            self.send_body(503)
+        else:
+            self.send_body(404)
+
+    do_GET = do_HEAD = handle_request
+
+
+class HttpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever,
+                args=(SERVER_POLL_INTERVAL,))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        pool = http_lib.ConnectionPool()
+        self.addCleanup(pool.close)
+        for patcher in (
+                unittest.mock.patch.dict(os.environ,
+                    {'AUR_TOOLS_CACHE_DIR': cache_dir.name}),
+                unittest.mock.patch.object(http_lib, 'connection_pool', pool),
+                unittest.mock.patch.object(fetch_lib, '_circuit_breakers', {}),
+                unittest.mock.patch.object(fetch_lib, 'BACKOFF_SECONDS', 0)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.start = metrics_lib.snapshot()
+
+    def get_url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_port, path)
+
+    def get_counter(self, name, **labels):
+        counters, _ = metrics_lib.get_difference(self.start,
+                metrics_lib.snapshot())
+        return counters.get(metrics_lib.get_key(name, labels), 0)
+
+    def get_requests(self, path):
+        with self.server.lock:
+            return [request for request in self.server.requests
+                    if request[1] == path]
+
+    def test_not_modified_served_from_cache(self):
+        with http_lib.urlopen(self.get_url('/etag')) as response:
+            self.assertEqual(response.read(), BODY)
+            self.assertFalse(response.from_cache)
+        with http_lib.urlopen(self.get_url('/etag')) as response:
+            self.assertEqual(response.read(), BODY)
+            self.assertTrue(response.from_cache)
+            self.assertEqual(response.validators['etag'], ETAG)
+        self.assertEqual(len(self.get_requests('/etag')), 2)
+        self.assertEqual(self.get_counter('cache_hits_total', cache='http'), 1)
+        self.assertEqual(self.get_counter('http_requests_total', status=304),
+                1)
+
+    def test_redirect(self):
+        with http_lib.urlopen(self.get_url('/redirect')) as response:
+            self.assertEqual(response.read(), BODY)
+            self.assertEqual(response.url, self.get_url('/etag'))
+        self.assertEqual(len(self.get_requests('/redirect')), 1)
+        self.assertEqual(len(self.get_requests('/etag')), 1)
+
+    def test_gzip_decoded(self):
+        for path in ('/gzip', '/gzip-etag'):
+            with self.subTest(path=path):
+                with http_lib.urlopen(self.get_url(path)) as response:
+                    self.assertEqual(response.read(), BODY)
+        # The cached body is stored decoded
+        with http_lib.urlopen(self.get_url('/gzip-etag')) as response:
+            self.assertTrue(response.from_cache)
+            self.assertEqual(response.read(), BODY)
+
+    def test_head_probe(self):
+        with http_lib.open_url(self.get_url('/etag'),
+                method='HEAD') as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), b'')
+        self.assertTrue(android_repo_lib.url_exists(self.get_url('/etag')))
+        self.assertFalse(android_repo_lib.url_exists(self.get_url('/none')))
+        self.assertTrue(android_repo_lib.url_exists(self.get_url('/no-head')))
+        self.assertEqual([method for method, _, _ in self.get_requests(
+            '/no-head')], ['HEAD', 'GET'])
+        self.assertEqual([method for method, _, _ in self.get_requests(
+            '/etag')], ['HEAD', 'HEAD'])
+
+    def test_connection_reused(self):
+        for path in ('/etag', '/etag', '/redirect', '/none', '/gzip'):
+            try:
+                with http_lib.urlopen(self.get_url(path)) as response:
+                    response.read()
+            except urllib.error.HTTPError as e:
+                e.close()
+        with self.server.lock:
+            ports = set(port for _, _, port in self.server.requests)
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(len(ports), 1)
+        self.assertEqual(self.get_counter('http_connections_total',
+            scheme='http'), 1)
+
+    def test_retried(self):
+        with http_lib.urlopen(self.get_url('/flaky')) as response:
+            self.assertEqual(response.read(), BODY)
+        self.assertEqual(len(self.get_requests('/flaky')),
+                FLAKY_FAILURES + 1)
+        self.assertEqual(self.get_counter('http_retries_total',
+            host='127.0.0.1'), FLAKY_FAILURES)
+
+    def test_retries_exhausted(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            http_lib.open_url(self.get_url('/down'))
+        context.exception.close()
+        self.assertEqual(context.exception.code, 503)
+        self.assertEqual(len(self.get_requests('/down')),
+                fetch_lib.DEFAULT_RETRIES + 1)
+
+    def test_circuit_opens(self):
+        with unittest.mock.patch.object(fetch_lib,
+                'CIRCUIT_FAILURE_THRESHOLD', 2):
+            # The retries stop once the circuit opens
+            with self.assertRaises(fetch_lib.CircuitOpenError):
+                http_lib.open_url(self.get_url('/down'))
+            with self.assertRaises(fetch_lib.CircuitOpenError):
+                http_lib.open_url(self.get_url('/etag'))
+        self.assertEqual(len(self.get_requests('/down')), 2)
+        self.assertEqual(len(self.get_requests('/etag')), 0)
+        self.assertEqual(self.get_counter('circuit_opens_total',
+            host='127.0.0.1'), 1)
+
+    def test_not_found_not_retried(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            http_lib.open_url(self.get_url('/none'))
+        context.exception.close()
+        self.assertEqual(context.exception.code, 404)
+        self.assertEqual(len(self.get_requests('/none')), 1)
+        self.assertIsNone(fetch_lib.get_circuit_breaker(
+            '127.0.0.1').opened_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
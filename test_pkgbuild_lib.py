@@ -0,0 +1,196 @@
+import benchmarks
+import pkgbuild_lib
+import random
+import shutil
+import subprocess
+import unittest
+
+
+# The cases of pacman's test/util/vercmptest.sh, as (ver1, ver2, expected).
+# Every case is also checked with the versions swapped.
+VERCMPTEST_CASES = [
+        # all similar length, no pkgrel
+        ('1.5.0', '1.5.0', 0),
+        ('1.5.1', '1.5.0', 1),
+        # mixed length
+        ('1.5.1', '1.5', 1),
+        # with pkgrel, simple
+        ('1.5.0-1', '1.5.0-1', 0),
+        ('1.5.0-1', '1.5.0-2', -1),
+        ('1.5.0-1', '1.5.1-1', -1),
+        ('1.5.0-2', '1.5.1-1', -1),
+        # with pkgrel, mixed lengths
+        ('1.5-1', '1.5.1-1', -1),
+        ('1.5-2', '1.5.1-1', -1),
+        ('1.5-2', '1.5.1-2', -1),
+        # mixed pkgrel inclusion
+        ('1.5', '1.5-1', 0),
+        ('1.5-1', '1.5', 0),
+        ('1.1-1', '1.1', 0),
+        ('1.0-1', '1.1', -1),
+        ('1.1-1', '1.0', 1),
+        # alphanumeric versions
+        ('1.5b-1', '1.5-1', -1),
+        ('1.5b', '1.5', -1),
+        ('1.5b-1', '1.5', -1),
+        ('1.5b', '1.5.1', -1),
+        # from the manpage
+        ('1.0a', '1.0alpha', -1),
+        ('1.0alpha', '1.0b', -1),
+        ('1.0b', '1.0beta', -1),
+        ('1.0beta', '1.0rc', -1),
+        ('1.0rc', '1.0', -1),
+        # going crazy? alpha-dotted versions
+        ('1.5.a', '1.5', 1),
+        ('1.5.b', '1.5.a', 1),
+        ('1.5.1', '1.5.b', 1),
+        # alpha dots and dashes
+        ('1.5.b-1', '1.5.b', 0),
+        ('1.5-1', '1.5.b', -1),
+        # same/similar content, differing separators
+        ('2.0', '2_0', 0),
+        ('2.0_a', '2_0.a', 0),
+        ('2.0a', '2.0.a', -1),
+        ('2___a', '2_a', 1),
+        # epoch included version comparisons
+        ('0:1.0', '0:1.0', 0),
+        ('0:1.0', '0:1.1', -1),
+        ('1:1.0', '0:1.0', 1),
+        ('1:1.0', '0:1.1', 1),
+        ('1:1.0', '2:1.1', -1),
+        # epoch + sometimes present pkgrel
+        ('1:1.0', '0:1.0-1', 1),
+        ('1:1.0-1', '0:1.1-1', 1),
+        # epoch included on one version
+        ('0:1.0', '1.0', 0),
+        ('0:1.0', '1.1', -1),
+        ('0:1.1', '1.0', 1),
+        ('1:1.0', '1.0', 1),
+        ('1:1.0', '1.1', 1),
+        ('1:1.1', '1.1', 1),
+]
+
+# Characters of the random versions compared with the vercmp binary
+FUZZ_ALPHABET = '019ab._+'
+FUZZ_SEED = 3
+FUZZ_PAIRS = 2000
+
+
+def make_random_version(rand):
+    version = ''.join(rand.choice(FUZZ_ALPHABET)
+            for _ in range(rand.randint(1, 6)))
+    if rand.random() < 0.2:
+        version = '{}:{}'.format(rand.randint(0, 2), version)
+    if rand.random() < 0.3:
+        version = '{}-{}'.format(version, rand.choice(['1', '2', '1.1', 'a']))
+    return version
+
+def run_vercmp_binary(ver1, ver2):
+    return int(subprocess.run(['vercmp', ver1, ver2], stdout=subprocess.PIPE,
+        universal_newlines=True, check=True).stdout)
+
+# The edits made by the updates of the benchmark PKGBUILDs
+REWRITTEN_VALUES = (('_apilevel', '30'), ('_rev', 'r01'), ('pkgrel', '2'))
+REWRITTEN_ARRAYS = ('source', 'sha1sums')
+
+
+def rewrite_with_regex(content, num_sources):
+    """Rewrite `content` like the updates did before `PkgbuildDocument`."""
+    for var_name, value in REWRITTEN_VALUES:
+        content = pkgbuild_lib.replace_pkgbuild_var_value(content, var_name,
+                value)
+    for var_name in REWRITTEN_ARRAYS:
+        bash_array, array_pattern = pkgbuild_lib.extract_array_var_pattern(
+                content, var_name)
+        content = content.replace(bash_array, array_pattern.format(
+            *['x{}'.format(i) for i in range(num_sources)]))
+    return content
+
+def rewrite_with_document(content, num_sources):
+    pkgbuild = pkgbuild_lib.PkgbuildDocument(content)
+    for var_name, value in REWRITTEN_VALUES:
+        pkgbuild.set_value(var_name, value)
+    for var_name in REWRITTEN_ARRAYS:
+        pkgbuild.set_array_values(var_name,
+                ['x{}'.format(i) for i in range(num_sources)])
+    return pkgbuild.render()
+
+
+class VercmpTest(unittest.TestCase):
+
+    def test_vercmptest_cases(self):
+        for ver1, ver2, expected in VERCMPTEST_CASES:
+            with self.subTest(ver1=ver1, ver2=ver2):
+                self.assertEqual(pkgbuild_lib.vercmp(ver1, ver2), expected)
+                self.assertEqual(pkgbuild_lib.vercmp(ver2, ver1), -expected)
+
+    def test_vercmp_key_orders_vercmptest_cases(self):
+        for ver1, ver2, expected in VERCMPTEST_CASES:
+            if expected == 0:
+                # vercmp ignores a missing pkgrel, vercmp_key does not
+                continue
+            with self.subTest(ver1=ver1, ver2=ver2):
+                key1 = pkgbuild_lib.vercmp_key(ver1)
+                key2 = pkgbuild_lib.vercmp_key(ver2)
+                self.assertEqual((key1 > key2) - (key1 < key2), expected)
+
+    @unittest.skipIf(shutil.which('vercmp') is None,
+            'the vercmp binary of pacman is not installed')
+    def test_same_as_vercmp_binary(self):
+        rand = random.Random(FUZZ_SEED)
+        pairs = [(ver1, ver2) for ver1, ver2, _ in VERCMPTEST_CASES]
+        pairs.extend((make_random_version(rand), make_random_version(rand))
+                for _ in range(FUZZ_PAIRS))
+        for ver1, ver2 in pairs:
+            with self.subTest(ver1=ver1, ver2=ver2):
+                self.assertEqual(pkgbuild_lib.vercmp(ver1, ver2),
+                        run_vercmp_binary(ver1, ver2))
+
+
+class PkgbuildDocumentTest(unittest.TestCase):
+
+    def test_same_values_as_regex(self):
+        for content, _ in benchmarks.make_pkgbuilds():
+            pkgbuild = pkgbuild_lib.PkgbuildDocument(content)
+            for var_name in ('pkgname', '_apilevel', '_rev', 'pkgrel'):
+                with self.subTest(content=content, var_name=var_name):
+                    self.assertEqual(pkgbuild.get_value(var_name),
+                            pkgbuild_lib.get_pkgbuild_value(content,
+                                var_name))
+
+    def test_same_rewrite_as_regex(self):
+        for content, num_sources in benchmarks.make_pkgbuilds():
+            with self.subTest(content=content):
+                expected = rewrite_with_regex(content, num_sources)
+                self.assertNotEqual(expected, content)
+                self.assertEqual(rewrite_with_document(content, num_sources),
+                        expected)
+
+    def test_assignment_anchored_at_line_start(self):
+        # The regex also matches the end of another name
+        content = '_pkgver=1.0\npkgver=2.0\n'
+        self.assertEqual(pkgbuild_lib.replace_pkgbuild_var_value(content,
+            'pkgver', '3.0'), '_pkgver=3.0\npkgver=2.0\n')
+        pkgbuild = pkgbuild_lib.PkgbuildDocument(content)
+        self.assertEqual(pkgbuild.get_value('pkgver'), '2.0')
+        pkgbuild.set_value('pkgver', '3.0')
+        self.assertEqual(pkgbuild.render(), '_pkgver=1.0\npkgver=3.0\n')
+
+    def test_parenthesis_in_quoted_array_item(self):
+        # The regex ends the array at the first parenthesis and leaves it
+        # untouched
+        content = 'source=("https://example.com/a(1).zip" \'b.zip\')\n'
+        bash_array, array_pattern = pkgbuild_lib.extract_array_var_pattern(
+                content, 'source')
+        self.assertEqual(bash_array, 'source=("https://example.com/a(1)')
+        self.assertEqual(content.replace(bash_array,
+            array_pattern.format('x0', 'x1')), content)
+        pkgbuild = pkgbuild_lib.PkgbuildDocument(content)
+        self.assertEqual(pkgbuild.get_array_values('source'),
+                ['https://example.com/a(1).zip', 'b.zip'])
+        pkgbuild.set_array_values('source', ['x0', 'x1'])
+        self.assertEqual(pkgbuild.render(), 'source=("x0" \'x1\')\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
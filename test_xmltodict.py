@@ -0,0 +1,53 @@
+import benchmarks
+import unittest
+import xmltodict
+
+
+FIXTURES = {
+        'repository': lambda: benchmarks.make_repository_xml(40),
+        'sys_img2': lambda: benchmarks.make_repository2_xml(
+            num_packages=100),
+        'addon2': lambda: benchmarks.make_repository2_xml(
+            root='repo:sdk-addon', num_packages=100),
+}
+
+
+def parse_streamed(content):
+    """Return the items streamed by `parse_fast` at depth 2, grouped by name
+    in lists like `parse` groups the children of the root."""
+    items = {}
+    def handle_item(path, item):
+        items.setdefault(path[-1][0], []).append(item)
+        return True
+    xmltodict.parse_fast(content, item_depth=2, item_callback=handle_item)
+    return items
+
+
+class ParseFastTest(unittest.TestCase):
+
+    def test_same_as_parse(self):
+        for name, make_content in sorted(FIXTURES.items()):
+            content = make_content()
+            with self.subTest(fixture=name):
+                self.assertEqual(xmltodict.parse_fast(content),
+                        xmltodict.parse(content))
+
+    def test_streamed_items_same_as_parse(self):
+        for name, make_content in sorted(FIXTURES.items()):
+            content = make_content()
+            root, = xmltodict.parse(content).values()
+            expected = {key: value if isinstance(value, list) else [value]
+                    for key, value in root.items()
+                    if not key.startswith('@')}
+            with self.subTest(fixture=name):
+                self.assertEqual(parse_streamed(content), expected)
+
+    def test_interrupted(self):
+        content = FIXTURES['sys_img2']()
+        with self.assertRaises(xmltodict.ParsingInterrupted):
+            xmltodict.parse_fast(content, item_depth=2,
+                    item_callback=lambda path, item: False)
+
+
+if __name__ == '__main__':
+    unittest.main()
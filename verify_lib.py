@@ -0,0 +1,282 @@
+import cache_lib
+import collections
+import concurrent.futures
+import hashlib
+import http_lib
+import json
+import metrics_lib
+import os
+import shutil
+import threading
+import urllib.error
+
+
+# Maps the prefix of the checksum arrays of a PKGBUILD to its hashlib name
+CHECKSUM_ALGORITHMS = {
+        'md5': 'md5',
+        'sha1': 'sha1',
+        'sha224': 'sha224',
+        'sha256': 'sha256',
+        'sha384': 'sha384',
+        'sha512': 'sha512',
+        'b2': 'blake2b',
+}
+# The algorithm under which the downloaded files are stored in the cache
+CONTENT_ALGORITHM = 'sha256'
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DEFAULT_MAX_DOWNLOADS = 4
+
+_download_locks = {}
+_download_locks_lock = threading.Lock()
+
+SourceFile = collections.namedtuple('SourceFile', ['url', 'checksums'])
+SourceFile.__doc__ = """An upstream file written in the source array of a
+PKGBUILD. `checksums` maps the prefix of the checksum arrays, like 'sha256',
+to the checksum upstream gives for the file."""
+
+
+class VerificationError(Exception):
+    pass
+
+
+def get_checksum_algorithm(name):
+    """Return the prefix of the PKGBUILD checksum array `name`, which may
+    also be the name of the array itself or of a hash of a dsc file, or
+    None if the checksum is not supported."""
+    name = name.lower()
+    if name.endswith('sums'):
+        name = name[:-len('sums')]
+    return name if name in CHECKSUM_ALGORITHMS else None
+
+def make_source_file(url, checksums):
+    """Return the `SourceFile` of `url` from `checksums` named like the
+    checksum arrays of a PKGBUILD or like the hashes of a dsc file. The
+    checksums that makepkg does not support are left out."""
+    source_checksums = {}
+    for name, value in checksums.items():
+        algorithm = get_checksum_algorithm(name)
+        if algorithm is not None:
+            source_checksums[algorithm] = value.lower()
+    return SourceFile(url, source_checksums)
+
+def get_cached_source_path(algorithm, digest):
+    return os.path.join(cache_lib.get_cache_dir('sources', algorithm), digest)
+
+def get_partial_download_paths(url):
+    """Return the paths of the partial download of `url` and of the
+    validators of the response it comes from."""
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    partial_dir = cache_lib.get_cache_dir('sources', 'partial')
+    return (os.path.join(partial_dir, key),
+            os.path.join(partial_dir, '{}.json'.format(key)))
+
+def get_download_lock(url):
+    with _download_locks_lock:
+        return _download_locks.setdefault(url, threading.Lock())
+
+def hash_file(f, algorithms, hashes=None):
+    """Update `hashes`, a dictionary mapping the algorithms to their hash
+    objects, with the rest of the file object `f` read in chunks, and return
+    it. The hashes of `algorithms` are created if missing."""
+    hashes = {} if hashes is None else hashes
+    for algorithm in algorithms:
+        if algorithm not in hashes:
+            hashes[algorithm] = hashlib.new(CHECKSUM_ALGORITHMS[algorithm])
+    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+        for hash_obj in hashes.values():
+            hash_obj.update(chunk)
+    return hashes
+
+def check_checksums(source, digests):
+    """Raise VerificationError if `digests` differ from the checksums of
+    `source`."""
+    for algorithm, expected in sorted(source.checksums.items()):
+        if digests[algorithm] != expected:
+            raise VerificationError('{} of {} is {}, not {}'.format(
+                algorithm, source.url, digests[algorithm], expected))
+
+def add_to_cache(path, url, digests):
+    """Move the file at `path` downloaded from `url` in the cache under each
+    of its `digests`."""
+    content_path = get_cached_source_path(CONTENT_ALGORITHM,
+            digests[CONTENT_ALGORITHM])
+    os.replace(path, content_path)
+    url_link_path = get_url_link_path(url)
+    tmp_link_path = '{}.tmp'.format(url_link_path)
+    if os.path.exists(tmp_link_path):
+        os.unlink(tmp_link_path)
+    link_cached_file(content_path, tmp_link_path)
+    os.replace(tmp_link_path, url_link_path)
+    for algorithm, digest in digests.items():
+        if algorithm == CONTENT_ALGORITHM:
+            continue
+        link_cached_file(content_path,
+                get_cached_source_path(algorithm, digest))
+    return content_path
+
+def get_url_link_path(url):
+    """Return the path linking `url` to the last file downloaded from it."""
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_lib.get_cache_dir('sources', 'url'), key)
+
+def link_cached_file(path, link_path):
+    try:
+        os.link(path, link_path)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(path, link_path)
+
+def get_missing_digests(path, source, algorithms):
+    """Return the digests of `algorithms` of the cached file at `path`, or
+    None if one of them differs from the checksums of `source`."""
+    if not algorithms:
+        return {}
+    with open(path, 'rb') as f:
+        hashes = hash_file(f, algorithms)
+    digests = {algorithm: hash_obj.hexdigest()
+            for algorithm, hash_obj in hashes.items()}
+    if any(digest != source.checksums[algorithm]
+            for algorithm, digest in digests.items()):
+        return None
+    return digests
+
+def find_cached_source(source):
+    """Return the path of the cached file of `source` or None if it is not
+    cached. The file is looked up by the checksums of `source`, then by its
+    url, in which case it is hashed again since upstream may have changed
+    it. Raise VerificationError if the file found by a checksum does not
+    have the other checksums."""
+    paths = {algorithm: get_cached_source_path(algorithm, digest)
+            for algorithm, digest in source.checksums.items()}
+    existing = sorted(path for path in paths.values()
+            if os.path.exists(path))
+    url_link_path = get_url_link_path(source.url)
+    if existing:
+        path = existing[0]
+        for other_path in existing[1:]:
+            if not os.path.samefile(path, other_path):
+                raise VerificationError(
+                        'The checksums of {} belong to different files'
+                        .format(source.url))
+    elif os.path.exists(url_link_path):
+        path = url_link_path
+    else:
+        return None
+
+    missing = [algorithm for algorithm, algorithm_path in paths.items()
+            if algorithm_path not in existing]
+    digests = get_missing_digests(path, source, missing)
+    if digests is None:
+        if path == url_link_path:
+            return None
+        raise VerificationError(
+                'The cached file of {} does not have its checksums'.format(
+                    source.url))
+    for algorithm, digest in digests.items():
+        link_cached_file(path, get_cached_source_path(algorithm, digest))
+    return path
+
+def open_download(url, partial_path, validators):
+    """Request `url`, resuming the partial download at `partial_path` when
+    there is one from a response with `validators`. Return the response and
+    whether it continues the partial download."""
+    headers = {}
+    offset = os.path.getsize(partial_path) if os.path.exists(
+            partial_path) else 0
+    validator = validators.get('etag') or validators.get('last_modified')
+    ranged = bool(offset and validator)
+    if ranged:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        headers['If-Range'] = validator
+    try:
+        with metrics_lib.timer('http_request_seconds'):
+            response = http_lib.open_url(url, headers)
+    except urllib.error.HTTPError as e:
+        metrics_lib.add('http_requests_total', status=e.code)
+        if e.code != 416 or not ranged:
+            raise
+        # The partial download is not a prefix of the file anymore
+        e.close()
+        os.unlink(partial_path)
+        return open_download(url, partial_path, {})
+    metrics_lib.add('http_requests_total', status=response.status)
+    content_range = response.headers.get('Content-Range', '')
+    resumed = (response.status == 206 and
+            content_range.startswith('bytes {}-'.format(offset)))
+    if response.status == 206 and not resumed:
+        response.close()
+        if not ranged:
+            raise VerificationError('Unexpected partial response for {}'
+                    .format(url))
+        os.unlink(partial_path)
+        return open_download(url, partial_path, {})
+    return response, resumed
+
+def download_source(source, algorithms):
+    """Download the file of `source` and compute its `algorithms` checksums
+    while it is written. A previous partial download of the same url is
+    resumed when the server allows it. Return the path of the downloaded
+    file and its digests."""
+    partial_path, validators_path = get_partial_download_paths(source.url)
+    try:
+        with open(validators_path, 'r') as f:
+            validators = json.load(f)
+    except (FileNotFoundError, ValueError):
+        validators = {}
+
+    response, resumed = open_download(source.url, partial_path, validators)
+    with response:
+        cache_lib.write_atomically(validators_path, json.dumps({
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }))
+        with open(partial_path, 'a+b' if resumed else 'w+b') as f:
+            # The bytes of the partial download are hashed from the disk
+            f.seek(0)
+            hashes = hash_file(f, algorithms)
+            if resumed:
+                metrics_lib.add('source_resumed_bytes_total', f.tell())
+            for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE),
+                    b''):
+                f.write(chunk)
+                metrics_lib.add('http_received_bytes_total', len(chunk))
+                for hash_obj in hashes.values():
+                    hash_obj.update(chunk)
+    os.unlink(validators_path)
+    return partial_path, {algorithm: hash_obj.hexdigest()
+            for algorithm, hash_obj in hashes.items()}
+
+def verify_source(source):
+    """Check that the file of the `SourceFile` has the checksums upstream
+    gives for it, downloading it unless a file with one of these checksums
+    is already cached. Return the path of the cached file. Raise
+    VerificationError if a checksum differs."""
+    if not source.checksums:
+        raise VerificationError('{} has no supported checksum'.format(
+            source.url))
+    with get_download_lock(source.url):
+        path = find_cached_source(source)
+        if path is not None:
+            metrics_lib.add('cache_hits_total', cache='sources')
+            return path
+        metrics_lib.add('cache_misses_total', cache='sources')
+
+        algorithms = set(source.checksums) | {CONTENT_ALGORITHM}
+        path, digests = download_source(source, algorithms)
+        try:
+            check_checksums(source, digests)
+        except VerificationError:
+            os.unlink(path)
+            raise
+        return add_to_cache(path, source.url, digests)
+
+def verify_sources(sources, max_workers=DEFAULT_MAX_DOWNLOADS):
+    """Verify every `SourceFile` of `sources`, downloading at most
+    `max_workers` of them at once. Return the paths of their cached files.
+    Raise the first VerificationError."""
+    if len(sources) <= 1:
+        return [verify_source(source) for source in sources]
+    with concurrent.futures.ThreadPoolExecutor(
+            min(max_workers, len(sources))) as executor:
+        return list(executor.map(verify_source, sources))
@@ -152,6 +152,100 @@ class _DictSAXHandler(object):
         return item
 
 
+class _FastDictSAXHandler(object):
+    """A `_DictSAXHandler` for the default options only, which builds plain
+    dicts. The keys are interned once per document, and the path is only
+    kept down to `item_depth` since it is only given to `item_callback`.
+    Unlike `_DictSAXHandler`, the items given to `item_callback` include
+    their own attributes and text."""
+    def __init__(self, item_depth=0, item_callback=None):
+        self.depth = 0
+        self.path = []
+        self.stack = []
+        self.data = None
+        self.item = None
+        self.item_depth = item_depth
+        self.item_callback = item_callback
+        self.names = {}
+        self.attr_keys = {}
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        if self.depth <= self.item_depth:
+            self.path.append((self.names.setdefault(name, name),
+                              dict(zip(attrs[0::2], attrs[1::2])) or None))
+        if self.depth >= self.item_depth:
+            self.stack.append((self.item, self.data))
+            if attrs:
+                attr_keys = self.attr_keys
+                item = {}
+                for i in range(0, len(attrs), 2):
+                    key = attrs[i]
+                    try:
+                        key = attr_keys[key]
+                    except KeyError:
+                        key = attr_keys[key] = '@' + key
+                    item[key] = attrs[i+1]
+                self.item = item
+            else:
+                self.item = None
+            self.data = None
+
+    def endElement(self, name):
+        depth = self.depth
+        if depth == self.item_depth:
+            item, data = self.item, self.data
+            if data is not None:
+                data = ''.join(data).strip() or None
+            if item is None:
+                item = data
+            elif data:
+                self.push_data(item, '#text', data)
+            if not self.item_callback(self.path, item):
+                raise ParsingInterrupted()
+            self.item, self.data = self.stack.pop()
+        elif self.stack:
+            item, data = self.item, self.data
+            self.item, self.data = self.stack.pop()
+            if data is not None:
+                data = ''.join(data).strip() or None
+            if item is not None:
+                if data:
+                    self.push_data(item, '#text', data)
+            else:
+                item = data
+            self.item = self.push_data(self.item,
+                                       self.names.setdefault(name, name),
+                                       item)
+        else:
+            self.item = self.data = None
+        if depth <= self.item_depth:
+            self.path.pop()
+        self.depth = depth - 1
+
+    def characters(self, data):
+        if self.depth < self.item_depth:
+            return
+        if self.data is None:
+            self.data = [data]
+        else:
+            self.data.append(data)
+
+    def push_data(self, item, key, data):
+        if item is None:
+            return {key: data}
+        try:
+            value = item[key]
+        except KeyError:
+            item[key] = data
+            return item
+        if isinstance(value, list):
+            value.append(data)
+        else:
+            item[key] = [value, data]
+        return item
+
+
 def parse(xml_input, encoding=None, expat=expat, process_namespaces=False,
           namespace_separator=':', **kwargs):
     """Parse the given XML input and convert it into a dictionary.
@@ -249,6 +343,45 @@ def parse(xml_input, encoding=None, expat=expat, process_namespaces=False,
     return handler.item
 
 
+def parse_fast(xml_input, encoding=None, expat=expat, item_depth=0,
+               item_callback=None):
+    """Parse the given XML input like `parse` with its default options, but
+    faster.
+
+    The result compares equal to the one of `parse`, with plain dicts in
+    place of `OrderedDict`. Namespaces are not processed and there is no
+    postprocessor.
+
+    The streaming mode differs from the one of `parse`: each item given to
+    `item_callback` is the element at `item_depth` as `parse` would build it
+    in the full document, with its attributes and its text, whereas the text
+    of the elements above `item_depth` is dropped.
+
+    A string or bytes input is parsed in a single expat call, a file-like
+    object is read by expat itself.
+
+    """
+    if item_depth and item_callback is None:
+        raise ValueError('item_callback is required with item_depth')
+    handler = _FastDictSAXHandler(item_depth, item_callback)
+    if isinstance(xml_input, _unicode):
+        if not encoding:
+            encoding = 'utf-8'
+        xml_input = xml_input.encode(encoding)
+    parser = expat.ParserCreate(encoding)
+    parser.ordered_attributes = True
+    parser.StartElementHandler = handler.startElement
+    parser.EndElementHandler = handler.endElement
+    parser.CharacterDataHandler = handler.characters
+    parser.buffer_text = True
+    parser.buffer_size = 64 * 1024
+    if isinstance(xml_input, bytes):
+        parser.Parse(xml_input, True)
+    else:
+        parser.ParseFile(xml_input)
+    return handler.item
+
+
 def _emit(key, value, content_handler,
           attr_prefix='@',
           cdata_key='#text',